@@ -0,0 +1,519 @@
+#!/usr/bin/env python
+# encoding: utf-8
+from collections import deque, OrderedDict
+import numpy as np
+from verifyio_graph import build_sync_edges
+
+'''
+Vector clocks of the segment heads of a CSRGraph.
+
+Most ranks only synchronize with a few other ranks, so most clock
+entries are zeros. Each row is stored either dense (a uint32 row of
+the dense matrix) or sparse (sorted ranks and values of the non-zero
+entries), depending on its fill ratio. A sparse entry takes twice the
+space of a dense one, so rows that are at least half full are
+stored dense.
+
+Rows are built with merge() in topological order, then pack()
+moves them into flat arrays:
+    dense:              (dense rows, width) uint32 matrix
+    sparse_ptr:         sparse row k is sparse_ptr[k]:sparse_ptr[k+1]
+    sparse_cols/vals:   ranks and values of all sparse rows
+    row_ids[seg]:       >= 0: row in dense, < 0: sparse row -(row_id+1)
+'''
+class ClockStore:
+    DENSE_FILL_RATIO = 0.5
+
+    def __init__(self, num_rows, width):
+        self.width = width
+        self.rows = [None] * num_rows   # ndarray (dense) or (cols, vals)
+
+    # Compute the row of seg from its predecessors.
+    # preds: list of (segment, rank, own entry) of all predecessors
+    # rank, own: rank and own entry of the segment head
+    def merge(self, seg, preds, rank, own):
+        width = self.width
+        rows = [self.rows[p[0]] for p in preds]
+        nnz = sum(width if type(row) is np.ndarray else len(row[0]) for row in rows)
+
+        # dense merge
+        if nnz >= width * self.DENSE_FILL_RATIO:
+            vc = np.zeros(width, dtype=np.uint32)
+            for row, (_, pred_rank, pred_own) in zip(rows, preds):
+                if type(row) is np.ndarray:
+                    np.maximum(vc, row, out=vc)
+                else:
+                    cols, vals = row
+                    vc[cols] = np.maximum(vc[cols], vals)
+                vc[pred_rank] = max(vc[pred_rank], pred_own)
+            vc[rank] = max(vc[rank], own)
+            if np.count_nonzero(vc) >= width * self.DENSE_FILL_RATIO:
+                self.rows[seg] = vc
+            else:
+                cols = np.flatnonzero(vc).astype(np.int32)
+                self.rows[seg] = (cols, vc[cols])
+            return
+
+        # sparse merge, keep the largest value of each rank
+        cols = np.concatenate([row[0] for row in rows] + [np.array([p[1] for p in preds] + [rank], dtype=np.int32)])
+        vals = np.concatenate([row[1] for row in rows] + [np.array([p[2] for p in preds] + [own], dtype=np.uint32)])
+        order = np.lexsort((vals, cols))
+        cols, vals = cols[order], vals[order]
+        keep = np.append(cols[1:] != cols[:-1], True) & (vals > 0)
+        self.rows[seg] = (cols[keep], vals[keep])
+
+    def pack(self):
+        empty = (np.empty(0, dtype=np.int32), np.empty(0, dtype=np.uint32))
+        rows = [empty if row is None else row for row in self.rows]
+        is_dense = np.array([type(row) is np.ndarray for row in rows], dtype=bool)
+        dense_segs, sparse_segs = np.flatnonzero(is_dense), np.flatnonzero(~is_dense)
+
+        self.row_ids = np.empty(len(rows), dtype=np.int64)
+        self.row_ids[dense_segs] = np.arange(len(dense_segs))
+        self.row_ids[sparse_segs] = -np.arange(1, len(sparse_segs)+1)
+
+        self.dense = np.stack([rows[s] for s in dense_segs]) if len(dense_segs) \
+                        else np.empty((0, self.width), dtype=np.uint32)
+        self.sparse_ptr = np.zeros(len(sparse_segs)+1, dtype=np.int64)
+        np.cumsum([len(rows[s][0]) for s in sparse_segs], out=self.sparse_ptr[1:])
+        self.sparse_cols = np.concatenate([empty[0]] + [rows[s][0] for s in sparse_segs])
+        self.sparse_vals = np.concatenate([empty[1]] + [rows[s][1] for s in sparse_segs])
+        # (sparse row, col) keys, sorted as the cols of each row are sorted
+        self.sparse_keys = np.repeat(np.arange(len(sparse_segs), dtype=np.int64), np.diff(self.sparse_ptr)) \
+                            * self.width + self.sparse_cols
+        self.rows = None
+
+    # number of stored entries
+    def num_entries(self):
+        return self.dense.size + len(self.sparse_cols)
+
+    # The row of seg as a dense vector clock
+    def get(self, seg):
+        row_id = self.row_ids[seg]
+        if row_id >= 0:
+            return self.dense[row_id].copy()
+        k = -row_id - 1
+        vc = np.zeros(self.width, dtype=np.uint32)
+        start, end = self.sparse_ptr[k], self.sparse_ptr[k+1]
+        vc[self.sparse_cols[start:end]] = self.sparse_vals[start:end]
+        return vc
+
+    # Entries (segs[i], cols[i]) of many rows at once
+    def entries(self, segs, cols):
+        row_ids = self.row_ids[segs]
+        vals = np.zeros(len(row_ids), dtype=np.uint32)
+        dense = row_ids >= 0
+        vals[dense] = self.dense[row_ids[dense], cols[dense]]
+        sparse = np.flatnonzero(~dense)
+        if len(sparse) and len(self.sparse_keys):
+            keys = (-row_ids[sparse] - 1) * self.width + cols[sparse]
+            i = np.minimum(np.searchsorted(self.sparse_keys, keys), len(self.sparse_keys)-1)
+            found = self.sparse_keys[i] == keys
+            vals[sparse[found]] = self.sparse_vals[i[found]]
+        return vals
+
+
+'''
+State of a forward search from a source node (see CSRGraph.reachable)
+    min_index:      rank -> smallest reached index of the rank
+    visited_ghosts: reached ghost nodes
+    stack:          node ids still to be expanded
+'''
+class ReachSearch:
+    __slots__ = ('min_index', 'visited_ghosts', 'stack')
+
+    def __init__(self, src_id):
+        self.min_index = {}
+        self.visited_ghosts = set()
+        self.stack = [src_id]
+
+
+'''
+Happens-before graph stored in numpy CSR arrays, an alternative
+to the networkx based VerifyIOGraph for large traces.
+
+Graph nodes are the dense integer ids of the NodeTable, ghost
+nodes are numbered after all table nodes (ghost node k has id
+len(nodes) + k and rank nprocs), same as VerifyIOGraph.
+
+Program-order edges are not stored: node id+1 is the program-order
+successor of node id if both are on the same rank. Only MPI edges
+and ghost edges are stored explicitly, in forward (succ_ptr,
+succ_ids) and reverse (pred_ptr, pred_ids) CSR arrays.
+
+The MPI edges and ghost nodes are built by build_sync_edges(),
+same as VerifyIOGraph.
+'''
+class CSRGraph:
+    REACH_CACHE_SIZE = 4096     # max number of cached searches (has_path)
+
+    def __init__(self, nodes, edges, include_vc=False):
+        self.nodes = nodes      # NodeTable of all VerifyIONodes
+        self.include_vc = include_vc
+        self.nprocs = nodes.nprocs
+        self.num_table_nodes = len(nodes)
+        self.num_ghost_nodes = 0
+        self.vc = None          # vector clocks, see run_vector_clock()
+        self.node_seg = None
+        self.tc = None          # tree clocks, see run_tree_clock()
+        self.closure = None     # see run_transitive_closure()
+        self.reach_cache = OrderedDict()    # source id -> ReachSearch
+        self.__build_graph(nodes, edges)
+
+    def num_nodes(self):
+        return self.num_table_nodes + self.num_ghost_nodes
+
+    # next (program-order) node of funcs in the same rank
+    def next_po_node(self, current, funcs):
+        return self.nodes.next_po_node(current, funcs)
+
+    # previous (program-order) node of funcs in the same rank
+    def prev_po_node(self, current, funcs):
+        return self.nodes.prev_po_node(current, funcs)
+
+    # Retrive rank from node id (nprocs for ghost nodes)
+    def id2rank(self, nid):
+        return int(self.ranks[nid])
+
+    # VerifyIONode of a node id, or a string for ghost nodes
+    def id2node(self, nid):
+        if nid < self.num_table_nodes:
+            return self.nodes.node(nid)
+        return "<Ghost %d>" %(nid - self.num_table_nodes)
+
+    # Program-order successor of every node id, -1 if none
+    def po_successors(self):
+        offsets = self.nodes.rank_offsets
+        po_next = np.arange(1, self.num_nodes()+1, dtype=np.int64)
+        po_next[offsets[1:][np.diff(offsets) > 0]-1] = -1    # last node of each (non-empty) rank
+        po_next[self.num_table_nodes:] = -1             # ghost nodes
+        return po_next
+
+    # Program-order predecessor of every node id, -1 if none
+    def po_predecessors(self):
+        offsets = self.nodes.rank_offsets
+        po_prev = np.arange(-1, self.num_nodes()-1, dtype=np.int64)
+        po_prev[offsets[:-1][np.diff(offsets) > 0]] = -1     # first node of each (non-empty) rank
+        po_prev[self.num_table_nodes:] = -1             # ghost nodes
+        return po_prev
+
+    def successors(self, nid):
+        succs = self.succ_ids[self.succ_ptr[nid]:self.succ_ptr[nid+1]].tolist()
+        if nid < self.num_table_nodes and self.nodes.index[nid] < self.nodes.num_rank_nodes(self.ranks[nid]) - 1:
+            succs.append(nid + 1)
+        return succs
+
+    def predecessors(self, nid):
+        preds = self.pred_ids[self.pred_ptr[nid]:self.pred_ptr[nid+1]].tolist()
+        if nid < self.num_table_nodes and self.nodes.index[nid] > 0:
+            preds.append(nid - 1)
+        return preds
+
+    # Return all node ids in a topological order (Kahn's algorithm).
+    # If the graph has cycles, nodes on or after a cycle are missing.
+    def topological_order(self):
+        num_nodes = self.num_nodes()
+        po_next = self.po_successors()
+        indegree = np.bincount(self.succ_ids, minlength=num_nodes)
+        indegree[po_next[po_next >= 0]] += 1
+
+        po_next = po_next.tolist()
+        indegree = indegree.tolist()
+        succ_ptr, succ_ids = self.succ_ptr.tolist(), self.succ_ids.tolist()
+
+        order = []
+        ready = deque(nid for nid in range(num_nodes) if indegree[nid] == 0)
+        while ready:
+            nid = ready.popleft()
+            order.append(nid)
+            succ = po_next[nid]
+            if succ >= 0:
+                indegree[succ] -= 1
+                if indegree[succ] == 0: ready.append(succ)
+            for succ in succ_ids[succ_ptr[nid]:succ_ptr[nid+1]]:
+                indegree[succ] -= 1
+                if indegree[succ] == 0: ready.append(succ)
+        self.__indegree = indegree
+        return np.array(order, dtype=np.int64)
+
+    # Return a list of edges that form a cycle, None if no cycles.
+    def find_cycle(self):
+        order = self.topological_order()
+        if len(order) == self.num_nodes():
+            return None
+        # Every node left by Kahn's algorithm has a predecessor
+        # that is also left, walk backwards until we see a node twice.
+        left = [d > 0 for d in self.__indegree]
+        nid = left.index(True)
+        path, seen = [], {}
+        while nid not in seen:
+            seen[nid] = len(path)
+            path.append(nid)
+            nid = next(p for p in self.predecessors(nid) if left[p])
+        cycle = path[seen[nid]:][::-1]
+        return [(cycle[i], cycle[(i+1) % len(cycle)]) for i in range(len(cycle))]
+
+    # Detect cycles of the graph, see VerifyIOGraph.check_cycles()
+    def check_cycles(self):
+        cycle = self.find_cycle()
+        if cycle is None:
+            return False
+        print("Generated graph contain cycles. Original code may have bugs.")
+        simplified_cycle = []
+        for c1, c2 in cycle:
+            if self.id2rank(c1) != self.id2rank(c2):
+                simplified_cycle.append((str(self.id2node(c1)), str(self.id2node(c2))))
+        print(simplified_cycle)
+        return True
+
+    # Check if dst is reachable from src. Program-order edges are
+    # followed implicitly: once a node of a rank is reached, all
+    # later nodes of that rank are reached, so we only remember
+    # the smallest reached index per rank and only expand the
+    # explicit edges of newly reached nodes.
+    #
+    # All nodes reachable from a node are reachable from the first
+    # node at or after it (on its rank) with explicit successors, so
+    # searches are started from that node. Searches stop as soon as
+    # dst is reached and are kept in a LRU cache, so later queries
+    # from the same node continue the search where it stopped.
+    def has_path(self, src, dst):
+        return self.reachable(src.id, dst.id)
+
+    def reachable(self, src_id, dst_id):
+        if src_id == dst_id:
+            return True
+        if src_id < self.num_table_nodes:
+            rank = self.ranks[src_id]
+            if self.ranks[dst_id] == rank and dst_id >= src_id:
+                return True
+            i = np.searchsorted(self.edge_src_ids, src_id)
+            if i == len(self.edge_src_ids) or self.edge_src_ids[i] >= self.nodes.rank_offsets[rank+1]:
+                return False
+            src_id = int(self.edge_src_ids[i])
+
+        search = self.reach_cache.get(src_id)
+        if search is None:
+            search = self.reach_cache[src_id] = ReachSearch(src_id)
+            if len(self.reach_cache) > self.REACH_CACHE_SIZE:
+                self.reach_cache.popitem(last=False)
+        else:
+            self.reach_cache.move_to_end(src_id)
+        return self.__search(search, dst_id)
+
+    # Continue a search until dst is reached (True)
+    # or there is nothing left to expand (False).
+    def __search(self, search, dst_id):
+        N = self.num_table_nodes
+        min_index, visited_ghosts, stack = search.min_index, search.visited_ghosts, search.stack
+        if dst_id >= N:
+            dst_rank, dst_index = -1, -1
+            if dst_id in visited_ghosts: return True
+        else:
+            dst_rank, dst_index = int(self.ranks[dst_id]), int(self.nodes.index[dst_id])
+            if min_index.get(dst_rank, dst_index+1) <= dst_index: return True
+
+        while stack:
+            nid = stack.pop()
+            if nid >= N:
+                if nid in visited_ghosts: continue
+                visited_ghosts.add(nid)
+                stack.extend(self.succ_ids[self.succ_ptr[nid]:self.succ_ptr[nid+1]].tolist())
+                if nid == dst_id: return True
+                continue
+
+            rank, index = int(self.ranks[nid]), int(self.nodes.index[nid])
+            old_index = min_index.get(rank, self.nodes.num_rank_nodes(rank))
+            if index >= old_index: continue
+            min_index[rank] = index
+
+            # explicit edges of nodes from index up to old_index
+            start = self.nodes.rank_offsets[rank]
+            lo = np.searchsorted(self.edge_src_ids, start + index)
+            hi = np.searchsorted(self.edge_src_ids, start + old_index)
+            for src in self.edge_src_ids[lo:hi].tolist():
+                stack.extend(self.succ_ids[self.succ_ptr[src]:self.succ_ptr[src+1]].tolist())
+
+            if rank == dst_rank and index <= dst_index:
+                return True
+        return False
+
+    def shortest_path(self, src, dst):
+
+        if (not src) or (not dst):
+            print("shortest_path Error: must specify src and dst (VerifyIONode)")
+            return []
+
+        # BFS from src, then walk back the parents from dst
+        parents = {src.id: None}
+        queue = deque([src.id])
+        while queue and dst.id not in parents:
+            nid = queue.popleft()
+            for succ in self.successors(nid):
+                if succ not in parents:
+                    parents[succ] = nid
+                    queue.append(succ)
+        if dst.id not in parents:
+            return []
+
+        path, nid = [], dst.id
+        while nid is not None:
+            path.append(self.id2node(nid))
+            nid = parents[nid]
+        return path[::-1]
+
+    # Only segment heads have a stored clock (see run_vector_clock),
+    # the clock of any other node is derived from its segment head.
+    def get_vector_clock(self, n):
+        vc = self.vc.get(self.node_seg[n.id])
+        vc[n.rank] = n.index
+        return vc
+
+    # Vector clock entries of many nodes at once:
+    # get_vector_clock(ids[i])[ranks[i]] for all i
+    def vector_clock_entries(self, ids, ranks):
+        vals = self.vc.entries(self.node_seg[ids], ranks)
+        own = self.ranks[ids] == ranks
+        vals[own] = self.nodes.index[ids[own]]
+        return vals
+
+    # Split the nodes into segments: a segment starts at a node that
+    # has explicit predecessors (or is the first node of a rank, or a
+    # ghost node) and contains all following nodes of the rank that
+    # only have a program-order predecessor.
+    #
+    # Return the first node id of each segment, the segment of
+    # each node id, and a topological order of the segments.
+    # caller need to assume there is no cycle in the DAG.
+    def segments(self):
+        N = self.num_table_nodes
+        num_nodes = self.num_nodes()
+
+        offsets = self.nodes.rank_offsets
+        is_head = np.diff(self.pred_ptr) > 0
+        is_head[offsets[:-1][np.diff(offsets) > 0]] = True     # first node of each (non-empty) rank
+        is_head[N:] = True
+        seg_starts = np.flatnonzero(is_head)
+        node_seg = np.cumsum(is_head, dtype=np.int64) - 1
+
+        # segment graph: explicit edges, plus program order between
+        # consecutive segments of the same rank
+        seg_heads = node_seg[np.repeat(np.arange(num_nodes), np.diff(self.succ_ptr))]
+        seg_tails = node_seg[self.succ_ids]
+        has_po_prev = np.flatnonzero(self.po_predecessors()[seg_starts] >= 0)
+        seg_heads = np.append(seg_heads, has_po_prev - 1)
+        seg_tails = np.append(seg_tails, has_po_prev)
+
+        # Kahn's algorithm over segments
+        num_segs = len(seg_starts)
+        out_ptr = np.zeros(num_segs+1, dtype=np.int64)
+        np.cumsum(np.bincount(seg_heads, minlength=num_segs), out=out_ptr[1:])
+        out_ptr = out_ptr.tolist()
+        out_ids = seg_tails[np.argsort(seg_heads, kind='stable')].tolist()
+        indegree = np.bincount(seg_tails, minlength=num_segs).tolist()
+
+        order = []
+        ready = deque(s for s in range(num_segs) if indegree[s] == 0)
+        while ready:
+            seg = ready.popleft()
+            order.append(seg)
+            for succ in out_ids[out_ptr[seg]:out_ptr[seg+1]]:
+                indegree[succ] -= 1
+                if indegree[succ] == 0: ready.append(succ)
+        return seg_starts, node_seg, order
+
+    # Only the head of a segment (see segments()) needs to merge
+    # its predecessors, the clock of every other node is the head's
+    # clock with its own index as own entry.
+    #
+    # So we only store the clocks of segment heads, in a ClockStore
+    # (self.vc) with one row per segment, the last column is for
+    # ghost nodes. self.node_seg maps node ids to segments.
+    def run_vector_clock(self):
+        N = self.num_table_nodes
+        seg_starts, node_seg, order = self.segments()
+
+        # own entry of each node: index, or ghost number for ghost nodes
+        own = np.empty(self.num_nodes(), dtype=np.uint32)
+        own[:N] = self.nodes.index
+        own[N:] = np.arange(self.num_ghost_nodes, dtype=np.uint32)
+        own, ranks = own.tolist(), self.ranks.tolist()
+        node_seg_list = node_seg.tolist()
+
+        vc = ClockStore(len(seg_starts), self.nprocs+1)
+        po_prev = self.po_predecessors()[seg_starts].tolist()
+        pred_ptr, pred_ids = self.pred_ptr.tolist(), self.pred_ids.tolist()
+        for seg in order:
+            head = int(seg_starts[seg])
+
+            # merge all predecessors of the head, the clock of a
+            # predecessor is the row of its segment with its own entry
+            preds = pred_ids[pred_ptr[head]:pred_ptr[head+1]]
+            if po_prev[seg] >= 0:
+                preds.append(po_prev[seg])
+            vc.merge(seg, [(node_seg_list[p], ranks[p], own[p]+1) for p in preds], ranks[head], own[head])
+        vc.pack()
+        self.vc = vc
+        self.node_seg = node_seg
+
+    # Same as run_vector_clock(), but using
+    # tree clocks (see tree_clock.py)
+    def run_tree_clock(self):
+        from tree_clock import TreeClockHB
+        self.tc = TreeClockHB(self)
+
+    # Clock entry of rank for node n, same
+    # as get_vector_clock(n)[rank]
+    def get_tree_clock_entry(self, n, rank):
+        return self.tc.get(n, rank)
+
+    # Transitive closure over the sync
+    # skeleton (see transitive_closure.py)
+    def run_transitive_closure(self):
+        from transitive_closure import SyncClosure
+        self.closure = SyncClosure(self)
+
+    # Check if dst is reachable from src using the transitive
+    # closure, False if src is dst (same as the vector clocks)
+    def closure_has_path(self, src, dst):
+        return self.closure.has_path(src, dst)
+
+    # A networkx DiGraph of this graph (e.g., for plotting)
+    def to_networkx(self):
+        import networkx as nx
+        G = nx.DiGraph()
+        G.add_nodes_from(range(self.num_nodes()))
+        po_next = self.po_successors()
+        has_next = np.flatnonzero(po_next >= 0)
+        G.add_edges_from(zip(has_next.tolist(), po_next[has_next].tolist()))
+        heads = np.repeat(np.arange(self.num_nodes()), np.diff(self.succ_ptr))
+        G.add_edges_from(zip(heads.tolist(), self.succ_ids.tolist()))
+        return G
+
+    def plot_graph(self, fname):
+        import networkx as nx
+        import matplotlib.pyplot as plt
+        nx.draw_networkx(self.to_networkx())
+        #plt.savefig(fname)
+        plt.show()
+
+    # private method to build the CSR arrays
+    # called only by __init__
+    def __build_graph(self, all_nodes, mpi_edges):
+        heads, tails, ghost_node_count = build_sync_edges(all_nodes, mpi_edges)
+        self.num_ghost_nodes = ghost_node_count
+        num_nodes = self.num_nodes()
+
+        def to_csr(src, dst):
+            order = np.argsort(src, kind='stable')
+            ptr = np.zeros(num_nodes+1, dtype=np.int64)
+            np.cumsum(np.bincount(src, minlength=num_nodes), out=ptr[1:])
+            return ptr, dst[order]
+
+        self.succ_ptr, self.succ_ids = to_csr(heads, tails)
+        self.pred_ptr, self.pred_ids = to_csr(tails, heads)
+        # sorted ids of nodes that have explicit successors
+        self.edge_src_ids = np.flatnonzero(np.diff(self.succ_ptr))
+
+        # rank of every node id, ghost nodes have rank nprocs
+        self.ranks = np.append(all_nodes.rank, np.full(ghost_node_count, self.nprocs, dtype=np.int32))
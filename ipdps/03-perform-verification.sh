@@ -17,8 +17,6 @@ if [[ ! -f "$PROGRAM" ]]; then
     exit 1
 fi
 
-SEMANTICS=("POSIX" "MPI-IO" "Commit" "Session")
-
 # Write all verifyio.py output to a single temporary text file first
 LIB_TRACE_DIR=$(basename ${BASE_DIR})
 ARR=(${LIB_TRACE_DIR//-/ })
@@ -26,12 +24,14 @@ LIB_NAME=${ARR[0]}
 TEXT_RESULT_FILE=/tmp/${LIB_NAME}.txt
 rm -f ${TEXT_RESULT_FILE}
 
+# Set CACHE=--cache to reuse decoded traces across repeated sweeps
+CACHE=${CACHE:-}
+
 for dir in "$BASE_DIR"/*/; do
     if [ -d "$dir" ]; then
         echo "Perform verification on $dir" | tee -a ${TEXT_RESULT_FILE}
-        for semantic in "${SEMANTICS[@]}"; do
-            python3 $PROGRAM $dir --semantics=$semantic | tee -a ${TEXT_RESULT_FILE}
-        done
+        # Verify POSIX, MPI-IO, Commit and Session semantics in one run
+        python3 $PROGRAM $dir --semantics=all ${CACHE} | tee -a ${TEXT_RESULT_FILE}
         echo "==============================================="
     fi
 done
@@ -10,6 +10,8 @@ import pandas as pd
 
 CSV_HEADER=['test', 'io_time', 'match_mpi_calls', 'mpi_edges', 'build_happens-before_graph', 'nodes','run_the_algorithm', 'verification_time', 'total_semantic_violation', 'total_conflict_pairs', 'semantics']
 
+SHARED_FIELDS=['io_time', 'match_mpi_calls', 'mpi_edges', 'build_happens-before_graph', 'nodes', 'run_the_algorithm', 'total_conflict_pairs']
+
 def parser(txt_file):
     with open(txt_file, "r") as file:
         log_data = file.read()
@@ -32,7 +34,7 @@ def parser(txt_file):
         if dir_match := dir_regex.match(line):
             test_name = dir_match.group(1)
         elif io_time_match := io_time_regex.search(line):
-            entry["io_time"] = io_time_match.group(1)
+            entry = {"io_time": io_time_match.group(1)}
         elif mpi_calls_match := mpi_calls_regex.search(line):
             entry["match_mpi_calls"] = mpi_calls_match.group(1)
             entry["mpi_edges"] = mpi_calls_match.group(2)
@@ -50,7 +52,9 @@ def parser(txt_file):
             entry["verification_time"] = verification_regex_match.group(2)
             entry["test"] = test_name 
             data.append(entry)
-            entry = {}
+            # a run may verify several semantics (--semantics all),
+            # steps 1-4 and the conflict pairs are shared by all of them
+            entry = {key: entry[key] for key in SHARED_FIELDS if key in entry}
 
     return data
 
@@ -1,7 +1,6 @@
 import sys
 from itertools import repeat
 from enum import Enum
-from verifyio_graph import VerifyIONode
 import read_nodes
 
 ANY_SOURCE = -1
@@ -82,9 +81,72 @@ class MPICall:
         return True
 
 
+# Names of the arguments recorded for each MPI call
+mpi_func_args_map = {
+    'MPI_Send':     ['dst', 'stag', 'comm'],
+    'MPI_Ssend':    ['dst', 'stag', 'comm'],
+    'MPI_Issend':   ['dst', 'stag', 'comm', 'req'],
+    'MPI_Isend':    ['dst', 'stag', 'comm', 'req'],
+    'MPI_Recv':     ['src', 'rtag', 'comm'],
+    'MPI_Sendrecv': ['src', 'dst', 'stag', 'rtag', 'comm'],
+    'MPI_Irecv':    ['src', 'rtag', 'comm', 'req'],
+    # for all MPI_Wait/test calls the C reader
+    # code will give us only a single argument
+    # 'req' that holds a list of completed reqs.
+    'MPI_Wait':     ['reqs'],
+    'MPI_Waitall':  ['reqs'],
+    'MPI_Waitany':  ['reqs'],
+    'MPI_Waitsome': ['reqs'],
+    'MPI_Test':     ['reqs'],
+    'MPI_Testall':  ['reqs'],
+    'MPI_Testany':  ['reqs'],
+    'MPI_Testsome': ['reqs'],
+    'MPI_Bcast':    ['src', 'comm'],
+    'MPI_Ibcast':   ['src', 'comm', 'req'],
+    'MPI_Reduce':   ['src', 'comm'],
+    'MPI_Ireduce':  ['src', 'comm', 'req'],
+    'MPI_Gather':   ['src', 'comm'],
+    'MPI_Igather':  ['src', 'comm', 'req'],
+    'MPI_Gatherv':  ['src', 'comm'],
+    'MPI_Igatherv': ['src', 'comm', 'req'],
+    'MPI_Barrier':          ['comm'],
+    'MPI_Alltoall':         ['comm'],
+    'MPI_Allreduce':        ['comm'],
+    'MPI_Allgatherv':       ['comm'],
+    'MPI_Reduce_scatter':   ['comm'],
+    'MPI_Comm_dup':         ['comm'],
+    'MPI_Comm_split':       ['comm'],
+    'MPI_Comm_split_type':  ['comm'],
+    'MPI_Cart_create':      ['comm'],
+    'MPI_Cart_sub':         ['comm'],
+    'MPI_File_open':        ['mpifh'],
+    'MPI_File_close':       ['mpifh'],
+    'MPI_File_read_at_all': ['mpifh'],
+    'MPI_File_write_at_all':['mpifh'],
+    'MPI_File_set_size':    ['mpifh'],
+    'MPI_File_set_view':    ['mpifh'],
+    'MPI_File_sync':        ['mpifh'],
+    'MPI_File_read_all':    ['mpifh'],
+    'MPI_File_read_ordered':['mpifh'],
+    'MPI_File_write_all':   ['mpifh'],
+    'MPI_File_write_ordered':['mpifh'],
+}
+
+# args: the decoded (str) arguments of the record
+def create_mpi_call(rank, seq_id, func, args):
+    if func in mpi_func_args_map:
+        arg_names = mpi_func_args_map[func]
+        mapped_args = dict(zip(arg_names, args))
+        return MPICall(rank, seq_id, func, **mapped_args)
+    else:
+        print(f"{func} not found in func_args_map")
+        return MPICall(rank, seq_id, func)
+
+
 class MPIMatchHelper:
-    def __init__(self, reader, mpi_sync_calls):
+    def __init__(self, reader, nodes, mpi_sync_calls, scan):
         self.recorder_reader = reader
+        self.nodes           = nodes        # NodeTable, nodes of the edges
         self.num_ranks       = reader.nprocs
         self.all_mpi_calls   = [[] for i in repeat(None, self.num_ranks)]
 
@@ -111,7 +173,8 @@ class MPIMatchHelper:
                     'MPI_File_write_ordered', 'MPI_File_set_size', 'MPI_File_set_view', 'MPI_File_sync',
                     'MPI_Comm_dup', 'MPI_Comm_split', 'MPI_Comm_split_type', 'MPI_Cart_create', 'MPI_Cart_sub']
 
-        self.translate_table = self.__generate_translation_table()
+        # Communicator translation table, generated by the trace scan
+        self.translate_table = scan.translate_table
 
     def is_send_call(self, func_name):
         if func_name in self.send_func_names:
@@ -145,77 +208,14 @@ class MPIMatchHelper:
             return MPICallType.MANY_TO_ONE
         return MPICallType.OTHER
 
-    def read_one_mpi_call(self, rank, seq_id, record):
-        func = self.recorder_reader.funcs[record.func_id]
-        func_args_map = {
-            'MPI_Send':     ['dst', 'stag', 'comm'],
-            'MPI_Ssend':    ['dst', 'stag', 'comm'],
-            'MPI_Issend':   ['dst', 'stag', 'comm', 'req'],
-            'MPI_Isend':    ['dst', 'stag', 'comm', 'req'],
-            'MPI_Recv':     ['src', 'rtag', 'comm'],
-            'MPI_Sendrecv': ['src', 'dst', 'stag', 'rtag', 'comm'],
-            'MPI_Irecv':    ['src', 'rtag', 'comm', 'req'],
-            # for all MPI_Wait/test calls the C reader
-            # code will give us only a single argument
-            # 'req' that holds a list of completed reqs.
-            'MPI_Wait':     ['reqs'],
-            'MPI_Waitall':  ['reqs'],
-            'MPI_Waitany':  ['reqs'],
-            'MPI_Waitsome': ['reqs'],
-            'MPI_Test':     ['reqs'],
-            'MPI_Testall':  ['reqs'],
-            'MPI_Testany':  ['reqs'],
-            'MPI_Testsome': ['reqs'],
-            'MPI_Bcast':    ['src', 'comm'],
-            'MPI_Ibcast':   ['src', 'comm', 'req'],
-            'MPI_Reduce':   ['src', 'comm'],
-            'MPI_Ireduce':  ['src', 'comm', 'req'],
-            'MPI_Gather':   ['src', 'comm'],
-            'MPI_Igather':  ['src', 'comm', 'req'],
-            'MPI_Gatherv':  ['src', 'comm'],
-            'MPI_Igatherv': ['src', 'comm', 'req'],
-            'MPI_Barrier':          ['comm'],
-            'MPI_Alltoall':         ['comm'],
-            'MPI_Allreduce':        ['comm'],
-            'MPI_Allgatherv':       ['comm'],
-            'MPI_Reduce_scatter':   ['comm'],
-            'MPI_Comm_dup':         ['comm'],
-            'MPI_Comm_split':       ['comm'],
-            'MPI_Comm_split_type':  ['comm'],
-            'MPI_Cart_create':      ['comm'],
-            'MPI_Cart_sub':         ['comm'],
-            'MPI_File_open':        ['mpifh'],
-            'MPI_File_close':       ['mpifh'],
-            'MPI_File_read_at_all': ['mpifh'],
-            'MPI_File_write_at_all':['mpifh'],
-            'MPI_File_set_size':    ['mpifh'],
-            'MPI_File_set_view':    ['mpifh'],
-            'MPI_File_sync':        ['mpifh'],
-            'MPI_File_read_all':    ['mpifh'],
-            'MPI_File_read_ordered':['mpifh'],
-            'MPI_File_write_all':   ['mpifh'],
-            'MPI_File_write_ordered':['mpifh'],
-        }
-        if func in func_args_map:
-            args = [record.args[i].decode("utf-8","ignore") for i in range(record.arg_count)]
-            arg_names = func_args_map[func]
-            mapped_args = dict(zip(arg_names, args))
-            return MPICall(rank, seq_id, func, **mapped_args)
-        else:
-            print(f"{func} not found in func_args_map")
-            return MPICall(rank, seq_id, func)
-
-    # Go through every record in the trace and preprocess
-    # the mpi calls, so they can be matched later.
-    def read_mpi_calls(self, reader):
+    # Go through the mpi calls collected by the trace
+    # scan and preprocess them, so they can be matched later.
+    def read_mpi_calls(self, scan):
         for rank in range(self.num_ranks):
-            records = reader.records[rank]
-            for seq_id in range(reader.num_records[rank]):
+            for mpi_call in scan.mpi_calls[rank]:
 
-                func_name = reader.funcs[records[seq_id].func_id]
-                if func_name not in read_nodes.accepted_mpi_funcs: continue
-
-                mpi_call = self.read_one_mpi_call(rank, seq_id, records[seq_id])
+                func_name = mpi_call.func
+                mpi_call.matched = False
 
                 self.all_mpi_calls[rank].append(mpi_call)
 
@@ -243,32 +243,6 @@ class MPIMatchHelper:
                         else:
                             self.wait_test_calls[rank][req] = [mpi_call]
 
-
-    def __generate_translation_table(self):
-        func_list = self.recorder_reader.funcs
-
-        translate = {}
-        translate['MPI_COMM_WORLD'] = range(self.num_ranks)
-
-        for rank in range(self.num_ranks):
-            records = self.recorder_reader.records[rank]
-            for i in range(self.recorder_reader.num_records[rank]):
-                record = records[i]
-                func = func_list[record.func_id]
-
-                comm, local_rank, world_rank = None, rank, rank
-
-                if func in ['MPI_Comm_split', 'MPI_Comm_split_type', 'MPI_Comm_dup', \
-                            'MPI_Cart_create' 'MPI_Comm_create', 'MPI_Cart_sub']:
-                    comm = record.args[0].decode("utf-8", "ignore")
-                    local_rank = int(record.args[1])
-
-                if comm:
-                    if comm not in translate:
-                        translate[comm] = list(range(self.num_ranks))
-                    translate[comm][local_rank] = world_rank
-        return translate
-
     # Communicator local rank to global rank
     def local2global(self, comm, local_rank):
         return self.translate_table[comm][local_rank]
@@ -318,8 +292,7 @@ def find_wait_test_call(nb_call, helper, need_match_src_tag=False, src=0, tag=0)
 def match_collective(mpi_call, helper):
 
     def add_nodes_to_edge(edge, call):
-        node = VerifyIONode(call.rank, call.seq_id, call.func)
-        if "MPI_File" in call.func: node.mpifh = call.mpifh
+        node = helper.nodes.find(call.rank, call.seq_id)
 
         # All-to-all (alltoall, barrier, etc.)
         if edge.call_type == MPICallType.ALL_TO_ALL:
@@ -383,7 +356,7 @@ def match_pt2pt(send_call, helper):
     head_node = None
     tail_node = None
 
-    head_node = VerifyIONode(send_call.rank, send_call.seq_id, send_call.func)
+    head_node = helper.nodes.find(send_call.rank, send_call.seq_id)
 
     # TODO: for non-blocking send/recv on both side, we actually
     # should generate two edges:
@@ -392,11 +365,11 @@ def match_pt2pt(send_call, helper):
     # Currently we return only Edge 1.
     '''
     if send_call.is_blocking_call():
-        head_node = VerifyIONode(send_call.rank, send_call.seq_id, send_call.func)
+        head_node = helper.nodes.find(send_call.rank, send_call.seq_id)
     else:
         wt_call = find_wait_test_call(send_call, helper)
         if wt_call:
-            head_node = VerifyIONode(wt_call.rank, wt_call.seq_id, wt_call.func)
+            head_node = helper.nodes.find(wt_call.rank, wt_call.seq_id)
         print(send_call.seq_id, send_call.rank, send_call.func, head_node)
     '''
 
@@ -417,7 +390,7 @@ def match_pt2pt(send_call, helper):
                 # and we use helper.recv_calls[][] to keep
                 # track of unmatched recv calls.
                 recv_call.matched = True
-                tail_node = VerifyIONode(recv_call.rank, recv_call.seq_id, recv_call.func)
+                tail_node = helper.nodes.find(recv_call.rank, recv_call.seq_id)
             else:
                 if recv_call.rtag == ANY_TAG or global_src == ANY_SOURCE:
                     wt_call = find_wait_test_call(recv_call, helper, True, send_call.rank, send_call.stag)
@@ -425,7 +398,7 @@ def match_pt2pt(send_call, helper):
                     wt_call = find_wait_test_call(recv_call, helper)
                 if wt_call:
                     recv_call.matched = True
-                    tail_node = VerifyIONode(wt_call.rank, wt_call.seq_id, wt_call.func)
+                    tail_node = helper.nodes.find(wt_call.rank, wt_call.seq_id)
                 else:
                     print("Warning: an nonblocking recv call could not find a matching wait/test call")
                     print("recv:", recv_call.rank, recv_call.seq_id, recv_call.func)
@@ -448,11 +421,20 @@ def match_pt2pt(send_call, helper):
 mpi_sync_calls=True will include only the calls
 that guarantee synchronization, this flag is used
 for checking MPI semantics
+
+nodes: the NodeTable of all nodes, the head/tail of the
+returned edges are VerifyIONodes of this table.
+
+scan: the TraceScan of the reader (see read_nodes.scan_trace),
+if not given the trace will be scanned again.
 '''
-def match_mpi_calls(reader, mpi_sync_calls=False):
+def match_mpi_calls(reader, nodes, scan=None, mpi_sync_calls=False):
+    if scan is None:
+        scan = read_nodes.scan_trace(reader)
+
     edges = []
-    helper = MPIMatchHelper(reader, mpi_sync_calls)
-    helper.read_mpi_calls(reader)
+    helper = MPIMatchHelper(reader, nodes, mpi_sync_calls, scan)
+    helper.read_mpi_calls(scan)
 
     for rank in range(helper.num_ranks):
         for mpi_call in helper.all_mpi_calls[rank]:
@@ -1,8 +1,9 @@
 #!/usr/bin/env python
 # encoding, utf-8
-import struct
+import os, struct
 from itertools import repeat
-from verifyio_graph import VerifyIONode
+import numpy as np
+from verifyio_graph import NodeTable
 
 accepted_mpi_funcs = [
  'MPI_Send', 'MPI_Ssend', 'MPI_Issend', 'MPI_Isend',
@@ -29,88 +30,276 @@ accepted_meta_funcs = [
  'fsync', 'open', 'fopen', 'close', 'fclose'
 ]
 
-def create_verifyio_node(rank_seqid_tuple, reader):
-    rank, seq_id = rank_seqid_tuple
-    func = reader.funcs[reader.records[rank][seq_id].func_id]
-    return VerifyIONode(rank, seq_id, func)
+# Lock calls. An I/O operation with a lock call within
+# lock_window records before or after it is considered
+# to be protected by locks.
+lock_funcs = ['fcntl', 'flock']
+lock_window = 5
 
+# Calls that create a new communicator, their first two
+# arguments are the new communicator and the local rank.
+comm_create_funcs = [
+ 'MPI_Comm_split', 'MPI_Comm_split_type', 'MPI_Comm_dup',
+ 'MPI_Comm_create', 'MPI_Cart_create', 'MPI_Cart_sub'
+]
+
+# Roles of a function during the trace scan (bit flags)
+ROLE_MPI         = 1    # accepted MPI call (node + MPICall)
+ROLE_META        = 2    # accepted metadata I/O call (node)
+ROLE_COMM_CREATE = 4    # communicator creation (translation table)
+
+
+'''
+Result of a single scan over all trace records.
+
+node_seq_ids[rank]: seq ids of accepted MPI and metadata calls
+node_fhs[rank]:     file handle of each node in node_seq_ids, i.e.,
+                    the MPI-IO file handle of MPI_File_* calls and
+                    the file name of metadata calls, otherwise None
+mpi_calls[rank]:    MPICall of accepted MPI calls
+translate_table:    communicator translation table
+                    translate_table[comm][local_rank] = world_rank
+'''
+class TraceScan:
+    def __init__(self, nprocs):
+        self.node_seq_ids = [[] for i in repeat(None, nprocs)]
+        self.node_fhs = [[] for i in repeat(None, nprocs)]
+        self.mpi_calls = [[] for i in repeat(None, nprocs)]
+        self.translate_table = {'MPI_COMM_WORLD': range(nprocs)}
 
-def read_verifyio_nodes_and_conflicts(reader):
 
-    vio_nodes = [[] for i in repeat(None, reader.nprocs)]
+# func_id -> role lookup table of a trace
+def build_role_table(reader):
+    roles = np.zeros(len(reader.funcs), dtype=np.uint8)
+    roles[reader.func_ids_of(accepted_mpi_funcs)]  |= ROLE_MPI
+    roles[reader.func_ids_of(accepted_meta_funcs)] |= ROLE_META
+    roles[reader.func_ids_of(comm_create_funcs)]   |= ROLE_COMM_CREATE
+    return roles
 
+
+# func_id -> number of leading arguments needed for the roles
+# of the function: the mapped arguments of MPI calls (the file
+# handle comes first for MPI_File_* calls), the file name of
+# metadata calls, and the communicator and local rank of
+# communicator creations.
+def build_arg_count_table(reader, roles):
+    from match_mpi import mpi_func_args_map
+
+    counts = [0] * len(reader.funcs)
+    for func_id, func in enumerate(reader.funcs):
+        if roles[func_id] & ROLE_MPI:
+            counts[func_id] = max(len(mpi_func_args_map.get(func, [])), 1 if func.startswith("MPI_File") else 0)
+        if roles[func_id] & ROLE_META:
+            counts[func_id] = max(counts[func_id], 1)
+        if roles[func_id] & ROLE_COMM_CREATE:
+            counts[func_id] = max(counts[func_id], 2)
+    return counts
+
+
+# Decode the first n arguments of a record, None for NULL arguments
+def decode_args(record, n):
+    return [None if record.args[i] is None else record.args[i].decode("utf-8", "ignore")
+            for i in range(min(n, record.arg_count))]
+
+
+'''
+Walk the trace records once and collect everything we need
+from them: the nodes of MPI and metadata calls, the
+MPICalls for matching, and the communicator translation table.
+Only records with a role are visited, and only the arguments
+needed for the roles of each visited record are decoded, once.
+'''
+def scan_trace(reader):
+    from match_mpi import create_mpi_call
+
+    scan = TraceScan(reader.nprocs)
+    roles = build_role_table(reader)
+    arg_counts = build_arg_count_table(reader, roles)
     func_list = reader.funcs
+
     for rank in range(reader.nprocs):
         records = reader.records[rank]
-        for seq_id in range(reader.num_records[rank]):
-            func = func_list[records[seq_id].func_id]
-            mpifh = None
+        func_ids = reader.func_ids[rank]
+        record_roles = roles[func_ids]
+        for seq_id in np.flatnonzero(record_roles).tolist():
+            role = record_roles[seq_id]
+            record = records[seq_id]
+            func_id = func_ids[seq_id]
+            func = func_list[func_id]
+            args = decode_args(record, arg_counts[func_id])
+
             # Retrive needed MPI calls
-            if func in accepted_mpi_funcs:
-                if func.startswith("MPI_File"):
-                    mpifh = records[seq_id].args[0].decode('utf-8')
-                mpi_node = VerifyIONode(rank, seq_id, func, -1, mpifh)
-                vio_nodes[rank].append(mpi_node)
+            if role & ROLE_MPI:
+                mpifh = args[0] if args and func.startswith("MPI_File") else None
+                scan.node_seq_ids[rank].append(seq_id)
+                scan.node_fhs[rank].append(mpifh)
+                scan.mpi_calls[rank].append(create_mpi_call(rank, seq_id, func, args))
             # Retrive needed metadata I/O calls
-            elif func in accepted_meta_funcs:
-                fh = records[seq_id].args[0].decode('utf-8')
-                metadata_io_node = VerifyIONode(rank, seq_id, func, -1, fh)
-                vio_nodes[rank].append(metadata_io_node)
+            elif role & ROLE_META:
+                scan.node_seq_ids[rank].append(seq_id)
+                scan.node_fhs[rank].append(args[0] if args else None)
+
+            if role & ROLE_COMM_CREATE:
+                comm, local_rank = args[0], int(args[1])
+                if comm not in scan.translate_table:
+                    scan.translate_table[comm] = list(range(reader.nprocs))
+                scan.translate_table[comm][local_rank] = rank
+
+    return scan
+
+# scan: the TraceScan of the reader, if not
+# given the trace will be scanned again.
+#
+# Returns the NodeTable of all nodes and the conflict groups.
+# The conflicting I/O operations are added to the nodes
+# in a first (streaming) pass over the conflict file. The returned
+# conflict groups are read lazily from the file again when they
+# are iterated, so they never need to be held in memory at once.
+def read_verifyio_nodes_and_conflicts(reader, scan=None):
+    if scan is None:
+        scan = scan_trace(reader)
+
+    # MPI calls and metadata I/O calls
+    rank_seq_ids = [list(seq_ids) for seq_ids in scan.node_seq_ids]
+    rank_fhs = [list(fhs) for fhs in scan.node_fhs]
 
     # Finally, retrive needed I/O calls according
     # to the conflict file
-    conflict_rank_seqid_groups = read_all_conflicts(reader)
-    unique_conflict_ops = {}
-
-    conflict_vio_node_groups = []
-
-    for cg in conflict_rank_seqid_groups:
-        # cg[0] is (c1_rank, c1_seq_id)
-        # cg[1] is rank grouped list of c2_rank, c2_seq_id)
-
-        if cg[0] not in unique_conflict_ops:
-            c1 = create_verifyio_node(cg[0], reader)
-            unique_conflict_ops[cg[0]] = c1
-            vio_nodes[cg[0][0]].append(c1)
-        else:
-            c1 = unique_conflict_ops[cg[0]]
-
-        c2s = [[] for _ in range(reader.nprocs)]
-        for c2_rank, c2s_per_rank in enumerate(cg[1]):
-            for c2_seq_id in c2s_per_rank:
-                c2_rank_seqid = (c2_rank, c2_seq_id)
-                if (c2_rank, c2_seq_id) not in unique_conflict_ops:
-                    c2 = create_verifyio_node(c2_rank_seqid, reader)
-                    unique_conflict_ops[c2_rank_seqid] = c2
-                    vio_nodes[c2_rank].append(c2)
-                else:
-                    c2 = unique_conflict_ops[c2_rank_seqid]
-                c2s[rank].append(c2)
-
-        group = [c1, c2s]
-        conflict_vio_node_groups.append(group)
+    for rank, seq_id in read_unique_conflict_ops(reader).tolist():
+        rank_seq_ids[rank].append(seq_id)
+        rank_fhs[rank].append(None)
 
+    vio_nodes = NodeTable(reader.funcs, reader.func_ids, rank_seq_ids, rank_fhs)
+    conflict_vio_node_groups = ConflictGroups(reader, vio_nodes)
     return vio_nodes, conflict_vio_node_groups
 
 
-def read_one_conflict_group(f, reader):
-    data = f.read(16)
-    if not data:
-        return None
+# Return a bool array over the node ids of nodes, True
+# if there is a lock call within lock_window records of the
+# node (i.e., seq_id-lock_window <= lock seq_id < seq_id+lock_window).
+# The window is clipped at 0. The original check, records[seq_id-5:
+# seq_id+5] on the ctypes record pointer, did not wrap a negative start
+# and read out-of-bounds records before the start of the rank.
+# TODO: the lock calls are not matched with the file of the
+# node, nor do we pair lock acquire/release.
+def build_lock_index(reader, nodes):
+    near_lock = np.zeros(len(nodes), dtype=bool)
+    lock_func_ids = reader.func_ids_of(lock_funcs)
+    if len(lock_func_ids) == 0:
+        return near_lock
+
+    for rank in range(reader.nprocs):
+        lock_seq_ids = np.flatnonzero(np.isin(reader.func_ids[rank], lock_func_ids))
+        if len(lock_seq_ids) == 0:
+            continue
+        start, end = nodes.rank_offsets[rank], nodes.rank_offsets[rank+1]
+        seq_ids = nodes.seq_id[start:end].astype(np.int64)
+        lo = np.searchsorted(lock_seq_ids, seq_ids - lock_window)
+        hi = np.searchsorted(lock_seq_ids, seq_ids + lock_window)
+        near_lock[start:end] = hi > lo
+    return near_lock
+
+
+'''
+A conflict group: n1 and all operations (n2s) conflicting with it.
+
+The n2s are stored in a compact CSR-like layout. Only ranks that
+have at least one n2 are kept:
+    ranks:      sorted ranks that have n2s
+    offsets:    offsets[i]:offsets[i+1] is the range of ranks[i]
+                in n2_ids (len(ranks)+1)
+    n2_ids:     node ids (in nodes) of all n2s, grouped by rank
+                in file order
+'''
+class ConflictGroup:
+    __slots__ = ('n1', 'ranks', 'offsets', 'n2_ids', 'nodes')
+
+    def __init__(self, n1, ranks, offsets, n2_ids, nodes):
+        self.n1 = n1            # VerifyIONode
+        self.ranks = ranks
+        self.offsets = offsets
+        self.n2_ids = n2_ids
+        self.nodes = nodes      # NodeTable
+
+    @classmethod
+    def from_pairs(cls, n1, pairs, nodes):
+        c2_ranks, c2_seq_ids = pairs['rank'], pairs['seq_id']
+        if np.any(c2_ranks[1:] < c2_ranks[:-1]):
+            order = np.argsort(c2_ranks, kind='stable')
+            c2_ranks, c2_seq_ids = c2_ranks[order], c2_seq_ids[order]
+        ranks, starts = np.unique(c2_ranks, return_index=True)
+        offsets = np.append(starts, len(c2_ranks))
+        n2_ids = np.empty(len(c2_seq_ids), dtype=np.int64)
+        for i, rank in enumerate(ranks.tolist()):
+            n2_ids[offsets[i]:offsets[i+1]] = nodes.ids_of(rank, c2_seq_ids[offsets[i]:offsets[i+1]])
+        return cls(n1, ranks, offsets, n2_ids, nodes)
+
+    def num_pairs(self):
+        return len(self.n2_ids)
+
+    # node ids of the n2s of a rank (empty if none)
+    def ids_of(self, rank):
+        i = np.searchsorted(self.ranks, rank)
+        if i == len(self.ranks) or self.ranks[i] != rank:
+            return self.n2_ids[0:0]
+        return self.n2_ids[self.offsets[i]:self.offsets[i+1]]
+
+    # VerifyIONode of the n2s of a rank
+    def __getitem__(self, rank):
+        return [self.nodes.node(nid) for nid in self.ids_of(rank).tolist()]
+
+    # Iterate over (rank, n2s of the rank) of all ranks that have n2s
+    def items(self):
+        for i, rank in enumerate(self.ranks.tolist()):
+            n2_ids = self.n2_ids[self.offsets[i]:self.offsets[i+1]].tolist()
+            yield rank, [self.nodes.node(nid) for nid in n2_ids]
+
+
+'''
+Iterable over the conflict groups (ConflictGroup) of a trace.
+
+The groups are decoded from the conflict file on the fly
+each time this object is iterated. start and end restrict the
+groups to a byte range of the file (see split()).
+'''
+class ConflictGroups:
+    def __init__(self, reader, nodes, start=0, end=None):
+        self.reader = reader
+        self.nodes = nodes      # NodeTable
+        self.start = start      # byte offset of the first group
+        self.end = end          # byte offset after the last group, None for end of file
 
-    conflict_ops = [[] for _ in range(reader.nprocs)]
+    def __iter__(self):
+        for c1, pairs in iter_conflict_groups(self.reader, self.start, self.end):
+            yield ConflictGroup.from_pairs(self.nodes.find(*c1), pairs, self.nodes)
 
-    # int, int, size_t
-    c1_rank, c1_seqid, num_pairs = struct.unpack("iiN", data)
+    # Split the groups into at most n consecutive shards of
+    # roughly the same number of pairs (i.e., bytes), in file order
+    def split(self, n):
+        offsets = conflict_group_offsets(self.reader)
+        end = offsets[-1] if self.end is None else self.end
+        offsets = offsets[(offsets >= self.start) & (offsets <= end)]
+        cuts = np.unique(offsets[np.searchsorted(offsets, np.linspace(self.start, end, n+1))])
+        return [ConflictGroups(self.reader, self.nodes, int(s), int(e)) for s, e in zip(cuts[:-1], cuts[1:])]
+
+
+# c2_rank:int, c2_seq_id:int of a conflict pair
+conflict_pair_dtype = np.dtype([('rank', np.int32), ('seq_id', np.int32)])
+# c1_rank:int, c1_seq_id:int, num_pairs:size_t of a conflict group
+conflict_group_header = struct.Struct("iiN")
+
+
+def read_one_conflict_group(f):
+    data = f.read(conflict_group_header.size)
+    if len(data) < conflict_group_header.size:
+        return None
+
+    c1_rank, c1_seqid, num_pairs = conflict_group_header.unpack(data)
     #print(c1_rank, c1_seqid, num_pairs)
-    offset = 0
-    data = f.read(4*num_pairs*2)
-    for i in range(num_pairs):
-        c2_rank, c2_seqid = struct.unpack("ii", data[offset:offset+8])
-        offset += 8
-        conflict_ops[c2_rank].append(c2_seqid)
-
-    conflict_group = ((c1_rank, c1_seqid), conflict_ops)
+    data = f.read(num_pairs * conflict_pair_dtype.itemsize)
+    pairs = np.frombuffer(data, dtype=conflict_pair_dtype)
+
+    conflict_group = ((c1_rank, c1_seqid), pairs)
     return conflict_group
 
 
@@ -124,24 +313,59 @@ for each conflict group:
     c1_rank:int, c1_seq_id:int, num_pairs:size_t
     c2_rank:int, c2_seq_id:int, c2_rank:int, c2_seq_id:int, ...
 
-This function returns a list of conflict groups, it will then
-be used later to create groups of VerifyIONode and return to
-the caller.
+This function is a generator that yields one conflict group at
+a time, so only a single group is in memory. The pairs of a
+group are decoded in one go as a numpy array of conflict_pair_dtype.
 Each conflict group has this format:
-[(c1_rank,c1_seq_id), [/*rank0:*/[seqid1, seqid2,...], /*rank1*/:[...] ]]
-
+((c1_rank, c1_seq_id), pairs)
+pairs['rank'], pairs['seq_id']: c2_rank and c2_seq_id of all pairs
+start, end: only read the groups in this byte range of the file
 '''
-def read_all_conflicts(reader):
-    conflict_groups = []
+def iter_conflict_groups(reader, start=0, end=None):
     with open(reader.logs_dir+"/conflicts.dat", mode="rb") as f:
-        while True:
-            conflict_group = read_one_conflict_group(f, reader)
+        f.seek(start)
+        while end is None or f.tell() < end:
+            conflict_group = read_one_conflict_group(f)
             if conflict_group:
-                conflict_groups.append(conflict_group)
+                yield conflict_group
             else:
                 # reached the end of file
                 break
-    return conflict_groups
+
+
+# Return the byte offsets of all conflict groups in the conflict
+# file, followed by the end of the last group. Only the group
+# headers are read.
+def conflict_group_offsets(reader):
+    offsets = []
+    with open(reader.logs_dir+"/conflicts.dat", mode="rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        pos = 0
+        while pos + conflict_group_header.size <= size:
+            offsets.append(pos)
+            f.seek(pos)
+            _, _, num_pairs = conflict_group_header.unpack(f.read(conflict_group_header.size))
+            pos += conflict_group_header.size + num_pairs * conflict_pair_dtype.itemsize
+    offsets.append(min(pos, size))
+    return np.array(offsets, dtype=np.int64)
+
+
+# Return all unique (rank, seq_id) of conflicting I/O operations
+# as a sorted (N, 2) array. Pairs are deduplicated per chunk, and
+# the unique keys of all chunks are merged once at the end, so
+# each pair is only sorted once.
+def read_unique_conflict_ops(reader, chunk_size=1<<20):
+    chunk_keys = []
+    chunk, chunk_len = [], 0
+    for c1, pairs in iter_conflict_groups(reader):
+        chunk.append(np.array([(c1[0] << 32) | c1[1]], dtype=np.int64))
+        chunk.append((pairs['rank'].astype(np.int64) << 32) | pairs['seq_id'])
+        chunk_len += len(pairs) + 1
+        if chunk_len >= chunk_size:
+            chunk_keys.append(np.unique(np.concatenate(chunk)))
+            chunk, chunk_len = [], 0
+    unique_keys = np.unique(np.concatenate(chunk_keys + chunk + [np.empty(0, dtype=np.int64)]))
+    return np.stack([unique_keys >> 32, unique_keys & 0xFFFFFFFF], axis=1)
 
 
 if __name__ == "__main__":
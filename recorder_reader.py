@@ -2,6 +2,8 @@
 # encoding: utf-8
 from ctypes import *
 import sys, os, glob, struct
+import numpy as np
+from trace_cache import TraceCache
 
 
 class VerifyIORecord(Structure):
@@ -33,13 +35,27 @@ self.funcs: a list of supported funcitons
 self.nprocs
 self.num_records[rank] 
 self.records[Rank]: per-rank list of VerifyIORecord
+self.func_ids[rank]: per-rank numpy array of func_id (columnar view of records)
+self.call_depths[rank]: per-rank numpy array of call_depth (columnar view of records)
 """
 class RecorderReader:
 
     def str2char_p(self, s):
         return c_char_p( s.encode('utf-8') )
     
-    def __init__(self, logs_dir):
+    # use_cache: read the decoded records from the on-disk cache
+    # in the trace folder if it is valid, otherwise read the trace
+    # with libreader and (re)write the cache.
+    def __init__(self, logs_dir, use_cache=False):
+        # Load function list and the number of processes
+        self.logs_dir = logs_dir
+        self.__read_num_procs(self.logs_dir + "/recorder.mt")
+        self.__load_func_list(self.logs_dir + "/recorder.mt")
+
+        cache = TraceCache(self.logs_dir) if use_cache else None
+        if cache and cache.load(self):
+            return
+
         if "RECORDER_INSTALL_PATH" not in os.environ:
             msg="Error:\n"\
                 "    RECORDER_INSTALL_PATH environment variable is not set.\n" \
@@ -58,11 +74,6 @@ class RecorderReader:
             print(msg)
             exit(1);
 
-        # Load function list and the number of processes
-        self.logs_dir = logs_dir
-        self.__read_num_procs(self.logs_dir + "/recorder.mt")
-        self.__load_func_list(self.logs_dir + "/recorder.mt")
-
         # Set up C reader library
         # Read all VerifyIORecord
         self.libreader = cdll.LoadLibrary(libreader_path)
@@ -73,6 +84,43 @@ class RecorderReader:
         for rank in range(self.nprocs):
             self.num_records[rank] = num_records[rank]
 
+        self.__build_columns()
+
+        if cache:
+            cache.save(self)
+
+    # Return the func ids of the given function names.
+    # Functions not recorded in this trace are ignored.
+    def func_ids_of(self, func_names):
+        ids = [self.func_id_map[f] for f in func_names if f in self.func_id_map]
+        return np.array(ids, dtype=np.int32)
+
+    # Build the per-rank columnar view of the records.
+    # libreader returns one contiguous VerifyIORecord array per rank,
+    # so we can map func_id and call_depth directly as (strided) numpy
+    # arrays without copying. This allows us to scan the trace with
+    # numpy rather than touching every ctypes record in Python. The
+    # ctypes records are only accessed when we need their args.
+    def __build_columns(self):
+        dtype = np.dtype({
+            'names':    ['func_id', 'call_depth'],
+            'formats':  [np.int32, np.uint8],
+            'offsets':  [VerifyIORecord.func_id.offset, VerifyIORecord.call_depth.offset],
+            'itemsize': sizeof(VerifyIORecord)
+        })
+        self.func_ids    = [None] * self.nprocs
+        self.call_depths = [None] * self.nprocs
+        for rank in range(self.nprocs):
+            n = self.num_records[rank]
+            if n == 0:
+                columns = np.empty(0, dtype=dtype)
+            else:
+                addr = cast(self.records[rank], c_void_p).value
+                buf = (c_char * (n * sizeof(VerifyIORecord))).from_address(addr)
+                columns = np.frombuffer(buf, dtype=dtype)
+            self.func_ids[rank]    = columns['func_id']
+            self.call_depths[rank] = columns['call_depth']
+
     # We dont need the entire RecorderMetadata
     # we only need to read the first integer, which
     # is the number of processes
@@ -87,6 +135,7 @@ class RecorderReader:
             f.seek(1024, 0)   # skip the reserved metadata block (fixed 1024 bytes)
             self.funcs = f.read().splitlines()
             self.funcs = [func.decode('utf-8') for func in self.funcs]
+        self.func_id_map = {func: i for i, func in enumerate(self.funcs)}
 
 
 
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# encoding: utf-8
+import os, json
+import numpy as np
+
+"""
+An opt-in on-disk cache of the decoded trace records.
+
+The cache is written into the trace folder (CACHE_DIR) the first time
+the trace is read with libreader. Later runs map the cached arrays
+directly from disk and do not need libreader at all.
+
+All records of all ranks are stored as flat numpy arrays. The
+arguments are only stored for the records that are used later, i.e.,
+the records visited by scan_trace() and the conflicting I/O operations
+in conflicts.dat. Other records are cached without arguments:
+    func_ids.npy:       func_id of each record
+    call_depths.npy:    call_depth of each record
+    record_offsets.npy: per-rank offsets into func_ids/call_depths (nprocs+1)
+    arg_offsets.npy:    per-record offsets into arg_ids (total records+1)
+    arg_ids.npy:        argument strings, as ids into the string table
+    strings.bin:        string table, all unique argument strings
+    string_offsets.npy: offsets into strings.bin (unique strings+1)
+    stamp.json:         size/mtime of the trace files (and conflicts.dat)
+                        when the cache was written
+
+The cache is invalidated when any of these files changes its size or mtime.
+"""
+
+CACHE_DIR = "verifyio-cache"
+CACHE_VERSION = 2
+
+
+class CachedRecord:
+    __slots__ = ('func_id', 'call_depth', 'arg_count', 'args')
+
+    def __init__(self, func_id, call_depth, args):
+        self.func_id    = func_id
+        self.call_depth = call_depth
+        self.arg_count  = len(args)
+        self.args       = args      # list of 'bytes', same as VerifyIORecord.args
+
+
+# Stand-in for reader.records[rank] when the trace is
+# loaded from the cache. Records are decoded on access. Records
+# whose arguments were not cached have no arguments (arg_count 0).
+class CachedRankRecords:
+    def __init__(self, cache, rank):
+        self.cache = cache
+        self.rank  = rank
+        self.start = int(cache.record_offsets[rank])
+        self.end   = int(cache.record_offsets[rank+1])
+
+    def __getitem__(self, seq_id):
+        if isinstance(seq_id, slice):
+            return [self[i] for i in range(*seq_id.indices(self.end - self.start))]
+        i = self.start + seq_id
+        arg_ids = self.cache.arg_ids[self.cache.arg_offsets[i]:self.cache.arg_offsets[i+1]]
+        args = [self.cache.get_string(arg_id) for arg_id in arg_ids.tolist()]
+        return CachedRecord(int(self.cache.func_ids[i]), int(self.cache.call_depths[i]), args)
+
+
+class TraceCache:
+    def __init__(self, logs_dir):
+        self.logs_dir  = logs_dir
+        self.cache_dir = os.path.join(logs_dir, CACHE_DIR)
+
+    # size and mtime of every trace file, including conflicts.dat
+    # as it decides which records keep their arguments.
+    def __stamp(self):
+        stamp = {}
+        for name in sorted(os.listdir(self.logs_dir)):
+            path = os.path.join(self.logs_dir, name)
+            if not os.path.isfile(path):
+                continue
+            st = os.stat(path)
+            stamp[name] = [st.st_size, st.st_mtime_ns]
+        return {'version': CACHE_VERSION, 'files': stamp}
+
+    def __path(self, name):
+        return os.path.join(self.cache_dir, name)
+
+    def is_valid(self):
+        try:
+            with open(self.__path("stamp.json"), "r") as f:
+                return json.load(f) == self.__stamp()
+        except (OSError, ValueError):
+            return False
+
+    def get_string(self, string_id):
+        if string_id < 0:
+            return None
+        return bytes(self.strings[self.string_offsets[string_id]:self.string_offsets[string_id+1]])
+
+    # Load the cached records into the reader.
+    # Return False if there is no valid cache, including
+    # missing or truncated cache files.
+    def load(self, reader):
+        if not self.is_valid():
+            return False
+
+        def load_array(name):
+            return np.load(self.__path(name), mmap_mode='r')
+
+        try:
+            self.func_ids       = load_array("func_ids.npy")
+            self.call_depths    = load_array("call_depths.npy")
+            self.record_offsets = load_array("record_offsets.npy")
+            self.arg_offsets    = load_array("arg_offsets.npy")
+            self.arg_ids        = load_array("arg_ids.npy")
+            self.string_offsets = load_array("string_offsets.npy")
+            self.strings        = np.memmap(self.__path("strings.bin"), dtype=np.uint8, mode='r') \
+                                    if self.string_offsets[-1] > 0 else np.empty(0, dtype=np.uint8)
+        except (OSError, ValueError, IndexError):
+            return False
+
+        if len(self.record_offsets) != reader.nprocs + 1 \
+                or len(self.func_ids) != self.record_offsets[-1] \
+                or len(self.call_depths) != self.record_offsets[-1] \
+                or len(self.arg_offsets) != self.record_offsets[-1] + 1 \
+                or len(self.arg_ids) != self.arg_offsets[-1] \
+                or len(self.strings) != self.string_offsets[-1]:
+            return False
+
+        reader.num_records = np.diff(self.record_offsets).tolist()
+        reader.func_ids    = [self.func_ids[self.record_offsets[r]:self.record_offsets[r+1]] for r in range(reader.nprocs)]
+        reader.call_depths = [self.call_depths[self.record_offsets[r]:self.record_offsets[r+1]] for r in range(reader.nprocs)]
+        reader.records     = [CachedRankRecords(self, r) for r in range(reader.nprocs)]
+        return True
+
+    # Write the records of a reader that has read the
+    # trace using libreader. A failed write (e.g., a read-only
+    # trace folder) only prints a warning, the run goes on
+    # without the cache.
+    def save(self, reader):
+        try:
+            self.__write(reader)
+        except OSError as e:
+            print("Warning: could not write the trace cache to %s: %s" %(self.cache_dir, e))
+
+    def __write(self, reader):
+        from read_nodes import build_role_table, read_unique_conflict_ops
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # Remove the old stamp first, so an interrupted
+        # write leaves an invalid cache behind.
+        if os.path.exists(self.__path("stamp.json")):
+            os.remove(self.__path("stamp.json"))
+
+        record_offsets = np.zeros(reader.nprocs+1, dtype=np.int64)
+        record_offsets[1:] = np.cumsum(reader.num_records)
+        total = int(record_offsets[-1])
+
+        # Records whose arguments are needed later: records with a
+        # role in scan_trace() and the conflicting I/O operations.
+        # Only those are touched through ctypes.
+        has_role = build_role_table(reader) != 0
+        needed = [has_role[func_ids] for func_ids in reader.func_ids]
+        if os.path.isfile(os.path.join(self.logs_dir, "conflicts.dat")):
+            for rank, seq_id in read_unique_conflict_ops(reader).tolist():
+                needed[rank][seq_id] = True
+
+        # Intern the argument strings of the needed records
+        string_table = {}
+        arg_counts = np.zeros(total, dtype=np.int64)
+        arg_ids = []
+        for rank in range(reader.nprocs):
+            records = reader.records[rank]
+            start = int(record_offsets[rank])
+            for seq_id in np.flatnonzero(needed[rank]).tolist():
+                record = records[seq_id]
+                arg_counts[start+seq_id] = record.arg_count
+                for a in range(record.arg_count):
+                    arg = record.args[a]
+                    if arg is None:     # NULL argument
+                        arg_ids.append(-1)
+                    else:
+                        arg_ids.append(string_table.setdefault(arg, len(string_table)))
+
+        arg_offsets = np.zeros(total+1, dtype=np.int64)
+        np.cumsum(arg_counts, out=arg_offsets[1:])
+        string_offsets = np.zeros(len(string_table)+1, dtype=np.int64)
+        np.cumsum([len(s) for s in string_table], out=string_offsets[1:])
+
+        concat = lambda arrays, dtype: np.concatenate(arrays).astype(dtype) if arrays else np.empty(0, dtype=dtype)
+        np.save(self.__path("func_ids.npy"), concat(reader.func_ids, np.int32))
+        np.save(self.__path("call_depths.npy"), concat(reader.call_depths, np.uint8))
+        np.save(self.__path("record_offsets.npy"), record_offsets)
+        np.save(self.__path("arg_offsets.npy"), arg_offsets)
+        np.save(self.__path("arg_ids.npy"), np.array(arg_ids, dtype=np.int32))
+        np.save(self.__path("string_offsets.npy"), string_offsets)
+        with open(self.__path("strings.bin"), "wb") as f:
+            f.write(b"".join(string_table))
+
+        with open(self.__path("stamp.json"), "w") as f:
+            json.dump(self.__stamp(), f)
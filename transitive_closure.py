@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# encoding: utf-8
+import numpy as np
+
+'''
+Transitive closure of a CSRGraph over its sync skeleton.
+
+Only nodes with explicit (MPI or ghost) edges matter for reachability
+across ranks, everything else follows from program order:
+    sources: nodes with explicit successors (src_ids)
+    targets: nodes with explicit predecessors (tgt_ids)
+
+For every source s we keep a packed bitset over the targets: bit j
+is set if tgt_ids[j] is reachable from s. The sets are closed under
+program order, i.e., once a target is reachable, so are all later
+targets of the same rank. They are computed in reverse topological
+order of the sources:
+
+    C(s) = targets from s on   U C(next source after s on its rank)
+           U for each successor t of s:
+               targets from t on U C(first source from t on)
+
+A node v1 reaches v2 of another rank if C(s1) contains t2, where s1
+is the first source at or after v1 and t2 is the last target at or
+before v2 on their ranks.
+
+Memory is sources x targets bits, so this is meant for traces with
+few sync nodes and many conflicting pairs.
+'''
+class SyncClosure:
+    def __init__(self, G):
+        self.G = G
+        self.src_ids = G.edge_src_ids
+        self.tgt_ids = np.flatnonzero(np.diff(G.pred_ptr))
+        # end (exclusive) of the program order of each
+        # node: rank end for nodes, id+1 for ghost nodes
+        self.po_ends = np.append(np.repeat(G.nodes.rank_offsets[1:], np.diff(G.nodes.rank_offsets)),
+                                 np.arange(G.num_table_nodes+1, G.num_nodes()+1))
+        self.__run()
+
+    # Row (in src_ids) of the first source in [nid, po end), -1 if none
+    def first_source(self, nid):
+        i = int(np.searchsorted(self.src_ids, nid))
+        if i < len(self.src_ids) and self.src_ids[i] < self.po_ends[nid]:
+            return i
+        return -1
+
+    # Range of target bits in [nid, po end)
+    def target_range(self, nid):
+        return int(np.searchsorted(self.tgt_ids, nid)), int(np.searchsorted(self.tgt_ids, self.po_ends[nid]))
+
+    def __run(self):
+        G = self.G
+        seg_starts, _, order = G.segments()
+        seg_ends = np.append(seg_starts[1:], G.num_nodes())
+
+        self.bits = np.zeros((len(self.src_ids), (len(self.tgt_ids)+7) // 8), dtype=np.uint8)
+        for seg in reversed(order):
+            lo = np.searchsorted(self.src_ids, seg_starts[seg])
+            hi = np.searchsorted(self.src_ids, seg_ends[seg])
+            for i in range(hi-1, lo-1, -1):
+                s = int(self.src_ids[i])
+                row = self.bits[i]
+                set_bits(row, *self.target_range(s))
+                rows = []
+                if i+1 < len(self.src_ids) and self.src_ids[i+1] < self.po_ends[s]:
+                    rows.append(i+1)
+                for t in G.succ_ids[G.succ_ptr[s]:G.succ_ptr[s+1]].tolist():
+                    set_bits(row, *self.target_range(t))
+                    j = self.first_source(t)
+                    if j >= 0: rows.append(j)
+                if rows:
+                    row |= np.bitwise_or.reduce(self.bits[rows], axis=0)
+
+    # Same result as comparing the vector clocks of src and dst
+    # (False if src is dst)
+    def has_path(self, src, dst):
+        if src.rank == dst.rank:
+            return src.index < dst.index
+        i = self.first_source(src.id)
+        if i < 0:
+            return False
+        j = int(np.searchsorted(self.tgt_ids, dst.id, side='right')) - 1
+        if j < 0 or self.tgt_ids[j] < self.G.nodes.rank_offsets[dst.rank]:
+            return False
+        return bool(self.bits[i, j >> 3] & (0x80 >> (j & 7)))
+
+
+# Set bits [start, end) of a packed (big bit order) uint8 row
+def set_bits(row, start, end):
+    if start >= end:
+        return
+    first, last = start >> 3, (end-1) >> 3
+    head = 0xFF >> (start & 7)
+    tail = (0xFF << (7 - ((end-1) & 7))) & 0xFF
+    if first == last:
+        row[first] |= head & tail
+    else:
+        row[first] |= head
+        row[first+1:last] = 0xFF
+        row[last] |= tail
@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+# encoding: utf-8
+import numpy as np
+
+'''
+Tree clocks, see Mathur et al., "A Tree Clock Data Structure for
+Causal Orderings in Concurrent Executions", ASPLOS 2022.
+
+A tree clock holds the same information as a vector clock (the
+latest known clock of every thread), but organizes the entries in
+a tree: a node u with child v means the owner learned v's clock
+through u, when u's clock was v.aclk. A join only visits the
+entries that actually change, so joins cost much less than
+O(nprocs) when only a few entries change.
+
+The tree is stored in flat per-thread lists, so a copy is a few
+list copies instead of one Python object per node:
+    clk[t]:     clock of thread t, 0 if unknown
+    aclk[t]:    clock of parent[t] when t was attached
+    parent[t]:  parent of t, -1 for the root and unknown threads
+    first[t]:   newest child of t, -1 if none
+    nxt[t]:     next older sibling of t, -1 if none
+    prv[t]:     next newer sibling of t, -1 if none
+Children are ordered by ascending aclk, i.e., newly attached
+children are the newest.
+'''
+class TreeClock:
+    def __init__(self, nthreads, tid=None, clk=0):
+        self.clk    = [0] * nthreads
+        self.aclk   = [0] * nthreads
+        self.parent = [-1] * nthreads
+        self.first  = [-1] * nthreads
+        self.nxt    = [-1] * nthreads
+        self.prv    = [-1] * nthreads
+        self.root   = tid
+        if tid is not None:
+            self.clk[tid] = clk
+
+    def get(self, tid):
+        return self.clk[tid]
+
+    # Join another tree clock into this one.
+    # root_clk: use this clock for the root of other instead of
+    #           other.clk[other.root] (the other clock's owner made
+    #           progress without learning anything new since other
+    #           was taken).
+    # If other has the same root (e.g., a ghost clock copied from
+    # this thread), the root is kept and the threads other learned
+    # about are attached with their aclk in other. Such a join must
+    # come before the other joins of the same root clock, so the
+    # children of the root stay ordered by aclk.
+    # Return the list of updated threads.
+    def join(self, other, root_clk=None):
+        z, root = other.root, self.root
+        z_clk = other.clk[z] if root_clk is None else root_clk
+        own = z == root
+        if not own and z_clk <= self.clk[z]:
+            return []
+
+        updated = self.__updated_threads(other)
+        clk, aclk, parent = self.clk, self.aclk, self.parent
+        first, nxt, prv = self.first, self.nxt, self.prv
+        o_clk, o_aclk, o_parent = other.clk, other.aclk, other.parent
+
+        # detach updated threads from their current parents
+        for u in updated:
+            p = parent[u]
+            if p >= 0:
+                if prv[u] >= 0: nxt[prv[u]] = nxt[u]
+                else:           first[p] = nxt[u]
+                if nxt[u] >= 0: prv[nxt[u]] = prv[u]
+                parent[u] = -1
+
+        # attach them again following the other tree, parents first,
+        # so the children of each parent are attached oldest first
+        root_aclk = clk[root]
+        for u in reversed(updated):
+            if u == root:
+                continue
+            p = o_parent[u]
+            if p < 0:           # root of other
+                clk[u], aclk[u], p = z_clk, root_aclk, root
+            else:
+                clk[u], aclk[u] = o_clk[u], o_aclk[u]
+            nxt[u], prv[u], parent[u] = first[p], -1, p
+            if first[p] >= 0: prv[first[p]] = u
+            first[p] = u
+
+        if own:
+            updated.pop()       # the root, always visited last
+        return updated
+
+    # Threads of other that carry new information, in post-order
+    # (children before parents). A child v of u only needs to be
+    # visited if it was attached to u after the time of u we know.
+    def __updated_threads(self, other):
+        clk = self.clk
+        o_clk, o_aclk, o_first, o_nxt = other.clk, other.aclk, other.first, other.nxt
+        updated = []
+        stack_u, stack_v = [other.root], [o_first[other.root]]
+        while stack_u:
+            u, v = stack_u[-1], stack_v[-1]
+            known_u = clk[u]
+            while v >= 0:
+                if clk[v] < o_clk[v]:
+                    break
+                v = -1 if o_aclk[v] <= known_u else o_nxt[v]
+            if v >= 0:
+                stack_v[-1] = o_nxt[v]
+                stack_u.append(v)
+                stack_v.append(o_first[v])
+            else:
+                updated.append(u)
+                stack_u.pop()
+                stack_v.pop()
+        return updated
+
+    def copy(self):
+        tc = TreeClock.__new__(TreeClock)
+        tc.clk, tc.aclk, tc.parent = self.clk[:], self.aclk[:], self.parent[:]
+        tc.first, tc.nxt, tc.prv = self.first[:], self.nxt[:], self.prv[:]
+        tc.root = self.root
+        return tc
+
+
+'''
+Happens-before clocks of a CSRGraph computed with tree clocks.
+
+Every rank keeps one live tree clock that is advanced segment by
+segment (see CSRGraph.segments()). The clock of a ghost node is a
+copy of the clock of its first involved call, joined with the clocks
+of the other involved calls. Ghost nodes need no thread of their
+own: nothing can learn the clock of an involved call other than
+through the ghost node, so the copied root stands for the ghost node.
+When a rank advances while a later segment still has to join its
+clock, the old clock is copied first.
+
+Clock entries follow the vector clock convention: the entry of rank r
+is the largest index+1 of the rank r nodes that happen before the
+node, and the own entry is the node's index. Instead of storing a
+full clock per segment, only the entries changed by each join are
+recorded, so get(n, rank) looks up the latest change at or before
+n's segment.
+'''
+class TreeClockHB:
+    def __init__(self, G):
+        self.G = G
+        self.nprocs = G.nprocs
+        self.__run()
+
+    def __run(self):
+        G, nprocs = self.G, self.nprocs
+        N = G.num_table_nodes
+        seg_starts, node_seg, order = G.segments()
+        ranks = G.ranks.tolist()
+        index = G.nodes.index.tolist()
+        num_segs = len(seg_starts)
+        pred_ptr, pred_ids = G.pred_ptr.tolist(), G.pred_ids.tolist()
+        node_seg_list = node_seg.tolist()
+
+        # number of explicit edges leaving each segment, a segment's
+        # clock is needed until all of them have been joined
+        pending = np.bincount(node_seg[np.repeat(np.arange(G.num_nodes()), np.diff(G.succ_ptr))],
+                              minlength=num_segs).tolist()
+
+        live = [None] * nprocs      # live tree clock of each rank
+        live_seg = [-1] * nprocs    # segment of the live tree clock
+        saved = {}                  # segment -> copied or ghost tree clock
+        upd_keys, upd_vals = [], []
+
+        def clock_of(p):
+            seg = node_seg_list[p]
+            if p >= N:
+                return saved[seg], None
+            tc = saved.get(seg)
+            if tc is None:
+                tc = live[ranks[p]]
+            return tc, index[p] + 1
+
+        def release(p):
+            seg = node_seg_list[p]
+            pending[seg] -= 1
+            if pending[seg] == 0:
+                saved.pop(seg, None)
+
+        for seg in order:
+            head = int(seg_starts[seg])
+            preds = pred_ids[pred_ptr[head]:pred_ptr[head+1]]
+
+            # ghost node
+            if head >= N:
+                tc, root_clk = clock_of(preds[0])
+                tc = tc.copy()
+                tc.clk[tc.root] = root_clk
+                release(preds[0])
+                for p in preds[1:]:
+                    tc.join(*clock_of(p))
+                    release(p)
+                if pending[seg] > 0:
+                    saved[seg] = tc
+                continue
+
+            rank = ranks[head]
+            tc = live[rank]
+            if tc is None:
+                tc = live[rank] = TreeClock(nprocs, rank)
+            elif pending[live_seg[rank]] > 0:
+                saved[live_seg[rank]] = tc.copy()
+            live_seg[rank] = seg
+            tc.clk[rank] = index[head] + 1
+
+            # ghost nodes (ids after all table nodes) first, their
+            # clock may be rooted at this rank (see TreeClock.join)
+            key_base = rank * nprocs
+            clk = tc.clk
+            for p in sorted(preds, reverse=True):
+                for u in tc.join(*clock_of(p)):
+                    upd_keys.append((key_base + u) * num_segs + seg)
+                    upd_vals.append(clk[u])
+                release(p)
+
+        # Recorded changes sorted by (rank, entry, segment)
+        keys = np.array(upd_keys, dtype=np.int64)
+        order = np.argsort(keys, kind='stable')
+        self.keys = keys[order]
+        self.vals = np.array(upd_vals, dtype=np.uint32)[order]
+        self.num_segs = num_segs
+        self.node_seg = node_seg
+        self.num_updates = len(keys)
+
+    # Clock entry of rank for node n, same as G.get_vector_clock(n)[rank]
+    def get(self, n, rank):
+        if rank == n.rank:
+            return n.index
+        base = (n.rank * self.nprocs + rank) * self.num_segs
+        i = np.searchsorted(self.keys, base + self.node_seg[n.id], side='right') - 1
+        if i >= 0 and self.keys[i] >= base:
+            return int(self.vals[i])
+        return 0
+
+
+'''
+Benchmark tree clocks against the vector clock matrix of CSRGraph.
+
+usage: python tree_clock.py traces_folder
+'''
+if __name__ == "__main__":
+    import sys, time
+    from recorder_reader import RecorderReader
+    from read_nodes import read_verifyio_nodes_and_conflicts, scan_trace
+    from match_mpi import match_mpi_calls
+    from csr_graph import CSRGraph
+
+    reader = RecorderReader(sys.argv[1])
+    scan = scan_trace(reader)
+    nodes, _ = read_verifyio_nodes_and_conflicts(reader, scan)
+    G = CSRGraph(nodes, match_mpi_calls(reader, nodes, scan))
+
+    t1 = time.time()
+    G.run_vector_clock()
+    t2 = time.time()
+    tc = TreeClockHB(G)
+    t3 = time.time()
+
+    print("nprocs: %d, nodes: %d, segments: %d" %(G.nprocs, G.num_nodes(), tc.num_segs))
+    print("vector clock: %.3f secs, %d entries" %((t2-t1), G.vc.num_entries()))
+    print("tree clock:   %.3f secs, %d entries" %((t3-t2), tc.num_updates))
+
+    for nid in range(len(nodes)):
+        n = nodes.node(nid)
+        vc = G.get_vector_clock(n)
+        for rank in range(G.nprocs):
+            assert vc[rank] == tc.get(n, rank), (str(n), rank)
+    print("tree clock entries match the vector clocks")
@@ -1,8 +1,14 @@
-import argparse, time, sys
+import argparse, time, sys, io, re, contextlib, multiprocessing
+import numpy as np
 from recorder_reader import RecorderReader
-from read_nodes import read_verifyio_nodes_and_conflicts
+from read_nodes import read_verifyio_nodes_and_conflicts, scan_trace, build_lock_index
 from match_mpi import match_mpi_calls
-from verifyio_graph import VerifyIONode, VerifyIOGraph
+from verifyio_graph import VerifyIONode, VerifyIOGraph, NodeTable
+from csr_graph import CSRGraph
+
+# Happens-before graph implementations (--graph_backend).
+# networkx is the reference implementation.
+graph_backends = {"csr": CSRGraph, "networkx": VerifyIOGraph}
 
 """
 A data structure to make it easier
@@ -10,36 +16,21 @@ to pass around infomration
 """
 class VerifyIO:
     def __init__(self, args):
-        self.semantics = args.semantics             # Semantics to check
+        self.semantics = args.semantics[0]          # Semantics being checked (one of args.semantics)
         self.algorithm = args.algorithm             # Algorithm for verification
         self.show_summary = args.show_summary       # whether to show summary in the end
         self.show_details = args.show_details       # whether to show violation details
         self.show_call_chain = args.show_call_chain # whether to show full call chain
-        if self.semantics == "Custom":
-            self.semantic_string = args.semantic_string # Custom semantics string
+        self.graph_backend = args.graph_backend     # Happens-before graph implementation
+        self.jobs = args.jobs                       # Number of processes for verification
+        if "Custom" in args.semantics:
+            self.custom_semantics = args.semantic_string # CustomSemantics compiled from --semantic_string
         self.reader = None                          # RecorderReader
-        self.G = None                               # Happens-before Graph (VerifyIOGraph)
-        self.all_nodes = None                       # Per-rank VerifyIONode list
-
-    def next_po_node(self, n, funcs):
-        if self.G:
-            return vio.G.next_po_node(n, funcs)
-        else:
-            if not funcs:
-                return self.all_nodes[n.rank][n.index+1]
-            for i in range(n.index+1, len(self.all_nodes[n.rank]), 1):
-                if self.all_nodes[n.rank][i].func in funcs:
-                    return self.all_nodes[n.rank][i]
-
-    def prev_po_node(self, n, funcs):
-        if self.G:
-            return self.G.prev_po_node(n, funcs)
-        else:
-            if not funcs:
-                return self.all_nodes[n.rank][n.index-1]
-            for i in range(n.index-1, 0, -1):
-                if self.all_nodes[n.rank][i].func in funcs:
-                    return self.all_nodes[n.rank][i]
+        self.G = None                               # Happens-before Graph (CSRGraph or VerifyIOGraph)
+        self.all_nodes = None                       # NodeTable of all VerifyIONodes
+        self.near_lock = None                       # nodes near fcntl/flock calls (build_lock_index)
+        self.mpi_edge_index = None                  # MPIEdgeIndex (algorithm 4)
+        self.epoch_verdicts = {}                    # (v1 id, v2 id) -> verified result of the current semantics
 
     def next_hb_node(self, n, funcs):
         if self.G:
@@ -61,11 +52,12 @@ For Session semantics:
 For MPI-IO semantics:
     - check if c1 po-> sync-hb-sync po-> c2
 
-We have four alogorithms:
+We have five alogorithms:
 Algo 1. Graph Reachibility (e.g., DFS)
 Algo 2. Transitivive Closure
 Algo 3. Vector Clock
 Algo 4. On-the-fly MPI Check
+Algo 5. Tree Clock
 
 TODO: choose algorithm dynamically
 """
@@ -78,50 +70,77 @@ def verify_pair_proper_synchronization(n1, n2, vio):
     # for lock acquire/realse or whther the file name is
     # the same as the I/O. This workaround works for the
     # tests we have.
-    for r in vio.reader.records[n1.rank][n1.seq_id-5:n1.seq_id+5]:
-        func_name = vio.reader.funcs[r.func_id]
-        if func_name == "fcntl" or func_name == "flock":
-            return True
+    if vio.near_lock[n1.id]:
+        return True
 
-    v1, v2 = None, None
+    return verify_pair_happens_before(n1, n2, vio)
 
-    if vio.semantics == "POSIX":
-        v1 = n1
-        v2 = n2
-    elif vio.semantics == "Commit":
-        v1 = vio.next_po_node(n1, ["fsync", "close", "fclose"])
-        v2 = n2
-    elif vio.semantics == "Session":
-        v1 = vio.next_po_node(n1, ["close", "fclose", "fsync"])
-        v2 = vio.prev_po_node(n2, ["open",  "fopen",  "fsync"])
-    elif vio.semantics == "MPI-IO":
-        next_sync = vio.next_po_node(n1, ["MPI_File_close", "MPI_File_sync"])
-        prev_sync = vio.prev_po_node(n2, ["MPI_File_open",  "MPI_File_sync"])
-        if (not next_sync) or (not prev_sync): return False
-        if vio.algorithm == 4:
-            v1 = next_sync
-        else:
-            # now we have two syncs
-            # check for the "barrier" of sync-barr-sync
-            # pass in funcs=None to get the immediate next/prev po node.
-            v1 = vio.next_po_node(next_sync, None)
-        v2 = prev_sync
-    elif vio.semantics == "Custom":
-        v1, v2 = custom_semantic(vio.semantic_string, n1, n2)
+
+# Sync calls of the built-in semantics: semantics ->
+# (sync calls after c1, sync calls before c2 or None for c2 itself)
+sync_funcs = {
+    "Commit":  (["fsync", "close", "fclose"], None),
+    "Session": (["close", "fclose", "fsync"], ["open", "fopen", "fsync"]),
+    "MPI-IO":  (["MPI_File_close", "MPI_File_sync"], ["MPI_File_open", "MPI_File_sync"]),
+}
+
+
+"""
+Same as verify_pair_proper_synchronization() but without
+the lock check, i.e., only checks the happens-before order
+of c1 and c2 for the given consistency semantics.
+
+For a fixed c1, the result is monotone along the program
+order of c2: if c1 is ordered before c2, then c1 is also
+ordered before every later c2 of the same rank. Similarly,
+for a fixed c2, if c1 is ordered before c2, so is every
+earlier c1 of the same rank.
+"""
+def verify_pair_happens_before(n1, n2, vio):
+
+    v1 = resolve_anchor(n1, 0, vio)
+    v2 = resolve_anchor(n2, 1, vio)
 
     if (not v1) or (not v2):
         return False
 
+    # For Session, MPI-IO (and Custom with a c2 anchor call) semantics
+    # the result only depends on the sync calls (epochs) v1 and v2
+    # resolve to, and many I/O operations share the same epochs. So we
+    # check each pair of epochs only once.
+    if shares_epochs(vio):
+        key = (v1.id, v2.id)
+        result = vio.epoch_verdicts.get(key)
+        if result is None:
+            result = vio.epoch_verdicts[key] = happens_before(v1, v2, vio)
+        return result
+
+    return happens_before(v1, v2, vio)
+
+
+# Whether c2 resolves to a sync call (an epoch) shared by other
+# I/O operations. For Commit (and Custom without c2 anchor calls)
+# the second anchor is a per-operation node, e.g., c2 itself, so
+# there is nothing to share.
+def shares_epochs(vio):
+    if vio.semantics == "Custom":
+        offset, funcs = vio.custom_semantics.sides[1]
+        return offset != 0 and funcs is not None
+    return vio.semantics in sync_funcs and sync_funcs[vio.semantics][1] is not None
+
+
+"""
+Check if v1 happens-before v2 using the selected algorithm
+"""
+def happens_before(v1, v2, vio):
+
     # Algorithm 1: Graph Reachibility
     if vio.algorithm == 1:
         return vio.G.has_path(v1, v2)
 
-    # Algorithm 2: Transitivive
+    # Algorithm 2: Transitive closure
     if vio.algorithm == 2:
-        print("transitive closure is alwasy slower than vector clock")
-        print("use vector clock instead")
-        vio.algorithm = 3
-        pass
+        return vio.G.closure_has_path(v1, v2)
 
     # Algorithm 3: Vector Clock
     if vio.algorithm == 3:
@@ -129,17 +148,171 @@ def verify_pair_proper_synchronization(n1, n2, vio):
         vc2 = vio.G.get_vector_clock(v2)
         return (bool)(vc1[v1.rank] < vc2[v1.rank])
 
+    # Algorithm 5: Tree Clock
+    if vio.algorithm == 5:
+        tc1 = vio.G.get_tree_clock_entry(v1, v1.rank)
+        tc2 = vio.G.get_tree_clock_entry(v2, v1.rank)
+        return (bool)(tc1 < tc2)
+
     # Algorithm 4: On-the-fly MPI check
     if vio.algorithm == 4:
-        # O(N) where N is remaining calls after v1
-        for next_mpi_call in vio.all_nodes[v1.rank][v1.index+1:]:
-            mpi_edge = mapped_mpi_edges[v1.rank].get(next_mpi_call.seq_id)
-            if mpi_edge and mpi_edge[v2.rank]:
-                if mpi_edge[v2.rank].seq_id < v2.seq_id:
-                    return True
-                else:
-                    return False
-        return False
+        # O(log N) where N is the number of MPI calls of
+        # v1.rank that have an edge with v2.rank
+        partner_seq_id = vio.mpi_edge_index.next_partner(v1.rank, v1.seq_id, v2.rank)
+        return (partner_seq_id >= 0) and (partner_seq_id < v2.seq_id)
+
+
+"""
+Anchors (v1, v2) of the conflicting operations for the current
+semantics, i.e., the nodes whose happens-before order decides
+whether c1 and c2 are properly synchronized:
+
+    POSIX:      c1, c2
+    Commit:     the next commit (fsync/close) after c1, c2
+    Session:    the next close after c1, the previous open before c2
+    MPI-IO:     the node after the next sync after c1 (the "barrier"
+                of sync-barrier-sync, the sync itself for algorithm 4),
+                the previous sync before c2
+    Custom:     see CustomSemantics
+
+resolve_anchor_ids() resolves the anchors of many nodes at once
+using the anchor tables of the NodeTable. As the same nodes are
+checked many times (with every peer rank and every conflict group
+they are part of), the results are memoized per (node, semantics)
+in the NodeTable (see NodeTable.anchor_memo()) by anchor_ids() and
+resolve_anchor().
+"""
+# Anchor ids of nodes (ids) as the first (c1) and as the
+# second (c2) operation of a pair, -1 if there is none
+def resolve_anchor_ids(ids, vio):
+    if vio.semantics == "POSIX":
+        return ids, ids
+
+    nodes = vio.all_nodes
+    if vio.semantics == "Custom":
+        return vio.custom_semantics.anchor_ids(ids, 0, nodes), vio.custom_semantics.anchor_ids(ids, 1, nodes)
+
+    after_funcs, before_funcs = sync_funcs[vio.semantics]
+    first_ids = nodes.anchor_tables(after_funcs)[0][ids]
+    second_ids = nodes.anchor_tables(before_funcs)[1][ids] if before_funcs else ids
+    if vio.semantics == "MPI-IO" and vio.algorithm != 4:
+        # the immediate next node of the sync (sync-barrier-sync)
+        rank_ends = nodes.rank_offsets[nodes.rank[np.maximum(first_ids, 0)] + 1]
+        first_ids = np.where((first_ids >= 0) & (first_ids + 1 < rank_ends), first_ids + 1, -1)
+    return first_ids, second_ids
+
+
+# Memoized resolve_anchor_ids()
+def anchor_ids(ids, vio):
+    if vio.semantics == "POSIX":
+        return ids, ids
+    memo = vio.all_nodes.anchor_memo(vio.semantics)
+    first_ids, second_ids = memo[0, ids], memo[1, ids]
+    missing = np.flatnonzero(first_ids == NodeTable.UNRESOLVED)
+    if len(missing):
+        missing_ids = ids[missing]
+        first_ids[missing], second_ids[missing] = resolve_anchor_ids(missing_ids, vio)
+        memo[0, missing_ids], memo[1, missing_ids] = first_ids[missing], second_ids[missing]
+    return first_ids, second_ids
+
+
+# Memoized anchor (VerifyIONode or None) of node n
+# as the first (side 0) or second (side 1) operation
+anchor_memo_block = 1024    # nodes resolved together on a miss
+
+def resolve_anchor(n, side, vio):
+    if vio.semantics == "POSIX":
+        return n
+    memo = vio.all_nodes.anchor_memo(vio.semantics)
+    aid = memo.item(side, n.id)
+    if aid == NodeTable.UNRESOLVED:
+        # resolve the whole block of n at once
+        start = n.id - n.id % anchor_memo_block
+        ids = np.arange(start, min(start + anchor_memo_block, len(vio.all_nodes)))
+        memo[0, ids], memo[1, ids] = resolve_anchor_ids(ids, vio)
+        aid = memo.item(side, n.id)
+    return vio.all_nodes.node(int(aid)) if aid >= 0 else None
+
+
+"""
+Batched version of verify_pair_happens_before() for the vector
+clock algorithm (algorithm 3) of CSRGraph: the anchors of many
+nodes are looked up at once (anchor_ids()), and happens_before_ids()
+compares the clock entries of many anchor pairs in one go.
+"""
+batch_pairs = 1 << 16     # conflict pairs verified per batch
+
+def use_batched_kernel(vio):
+    return vio.algorithm == 3 and vio.graph_backend == "csr"
+
+
+# v1_ids[i] hb-> v2_ids[i] for all i, False if either is -1
+def happens_before_ids(v1_ids, v2_ids, vio):
+    v1_ids, v2_ids = np.broadcast_arrays(v1_ids, v2_ids)
+    valid = (v1_ids >= 0) & (v2_ids >= 0)
+    v1_ids, v2_ids = np.where(valid, v1_ids, 0), np.where(valid, v2_ids, 0)
+    ranks = vio.all_nodes.rank[v1_ids]
+    return valid & (vio.G.vector_clock_entries(v1_ids, ranks) < vio.G.vector_clock_entries(v2_ids, ranks))
+
+
+"""
+Verify a batch of conflict groups (a list of ConflictGroup) with
+the batched kernel. Same checks as verify_conflict_groups(), but
+done for every (group, rank) segment of n2s at once, so the
+verdicts of all pairs are computed in a few numpy operations.
+Return the number of violations.
+"""
+def verify_groups_batched(groups, vio, summary):
+    n1_ids = np.array([group.n1.id for group in groups], dtype=np.int64)
+    n2_ids = np.concatenate([group.n2_ids for group in groups])
+    group_sizes = [group.num_pairs() for group in groups]
+    group_starts = np.cumsum([0] + group_sizes[:-1])
+
+    # (group, rank) segments of n2s and the segment/group of each pair
+    seg_starts = np.concatenate([group.offsets[:-1] + base for group, base in zip(groups, group_starts.tolist())])
+    seg_lens = np.diff(np.append(seg_starts, len(n2_ids)))
+    seg_ends = seg_starts + seg_lens - 1                    # last n2 of the segment
+    pair_seg = np.repeat(np.arange(len(seg_starts)), seg_lens)
+    pair_group = np.repeat(np.arange(len(groups)), group_sizes)
+
+    n1_first, n1_second = anchor_ids(n1_ids, vio)
+    n2_first, n2_second = anchor_ids(n2_ids, vio)
+    a = happens_before_ids(n1_first[pair_group], n2_second, vio)    # n1 hb-> n2
+    b = happens_before_ids(n2_first, n1_second[pair_group], vio)    # n2 hb-> n1
+    lk = vio.near_lock[n2_ids]
+    n1_lk = vio.near_lock[n1_ids][pair_group[seg_starts]]
+
+    # per segment, see the checks in verify_conflict_groups()
+    ok = n1_lk | a[seg_starts] | lk[seg_ends] | b[seg_ends]
+    all_bad = ~ok & ~a[seg_ends] & ~(lk[seg_starts] | b[seg_starts])
+    # by monotonicity, the n2s that n1 happens-before are a
+    # suffix and the n2s that happen-before n1 are a prefix
+    a_cnt, b_cnt = np.add.reduceat(a.astype(np.int64), seg_starts), np.add.reduceat(b.astype(np.int64), seg_starts)
+    first_after = seg_lens - (a_cnt - a[seg_starts])
+    first_not_before = b_cnt - b[seg_ends]
+
+    j = np.arange(len(n2_ids)) - seg_starts[pair_seg]
+    partial = ~ok & ~all_bad
+    violations = all_bad[pair_seg] | (partial[pair_seg] & ~lk &
+                    (j >= first_not_before[pair_seg]) & (j < first_after[pair_seg]))
+
+    if vio.show_summary:
+        for i in np.flatnonzero(violations).tolist():
+            get_violation_info([groups[pair_group[i]].n1, vio.all_nodes.node(int(n2_ids[i]))], vio, summary, False)
+    return int(np.count_nonzero(violations))
+
+
+# Group the conflict groups into lists of about max_pairs pairs
+def iter_group_batches(conflict_groups, max_pairs):
+    batch, num_pairs = [], 0
+    for group in conflict_groups:
+        batch.append(group)
+        num_pairs += group.num_pairs()
+        if num_pairs >= max_pairs:
+            yield batch
+            batch, num_pairs = [], 0
+    if batch:
+        yield batch
 
 
 """
@@ -147,82 +320,163 @@ For an execution, iterate through every conflicting pairs
 and verify if each conflict pair is properly synchornized for
 the given consistency semantics
 
- - conflict_pairs: list of (n1, n2s)
-    n1:  seq_id of conflicting I/O operation
-    n2s: list of seq id of I/O operations conflicting with n1.
+ - conflict_groups: iterable of ConflictGroup (see read_nodes.py)
+    group.n1:       conflicting I/O operation (VerifyIONode)
+    group.items():  (rank, n2s) of I/O operations conflicting with n1.
 """
-def verify_execution_proper_synchronization(conflict_pairs, vio:VerifyIO):
+def verify_execution_proper_synchronization(conflict_groups, vio:VerifyIO):
+
+    # Epoch verdicts are only kept for the semantics being checked
+    vio.epoch_verdicts.clear()
+
+    if vio.jobs > 1:
+        total_violations, total_conflicts, summary = verify_conflict_groups_parallel(conflict_groups, vio)
+    else:
+        total_violations, total_conflicts, summary = verify_conflict_groups(conflict_groups, vio)
+
+    if vio.show_summary:
+        print_summary(summary, vio.reader.nprocs)
+    print("Total semantic violations: %d" %total_violations)
+    print("Total conflict pairs: %d" %total_conflicts)
+
+
+"""
+Verify the given conflict groups, return the number of
+violations, the number of conflict pairs and the summary
+(None without --show_summary)
+"""
+def verify_conflict_groups(conflict_groups, vio:VerifyIO):
 
     total_conflicts = 0
     total_violations = 0
 
-    summary = {
-        'c_ranks_cnt': [[0 for _ in range(vio.reader.nprocs)] for _ in range(vio.reader.nprocs)],
-        'c_files_cnt': {},
-        'c_functions_cnt': {}
-    }
+    summary = new_summary() if vio.show_summary else None
+
+    if use_batched_kernel(vio):
+        for groups in iter_group_batches(conflict_groups, batch_pairs):
+            total_conflicts += sum(group.num_pairs() for group in groups)
+            total_violations += verify_groups_batched(groups, vio, summary)
+        return total_violations, total_conflicts, summary
 
-    for pair in conflict_pairs:
+    for group in conflict_groups:
 
         # n1: conflict I/O operation (VerifyIONode)
-        # n2s: conflicting I/O operations (array of VerifyIONode)
-        n1, n2s = pair[0], pair[1]
+        n1 = group.n1
 
-        s = 0
-        for i in range(len(n2s)):
-            s += len(n2s[i])
-        debug_str = f"Verify: {n1} {s} pairs"
+        debug_str = f"Verify: {n1} {group.num_pairs()} pairs"
         t1 = time.time()
 
-        for rank in range(len(n2s)):
-            if len(n2s[rank]) < 1: continue
-            total_conflicts += len(n2s[rank])
+        # n2s: conflicting I/O operations of a rank (array of VerifyIONode)
+        for rank, n2s in group.items():
+            total_conflicts += len(n2s)
 
-            # check if n1 happens-before the first node of n2s[rank]
-            # if n1 hb-> n2s[rank][0], then n1 hb-> n2s[rank][:]
-            if verify_pair_proper_synchronization(n1, n2s[rank][0], vio):
+            # check if n1 happens-before the first node of n2s
+            # if n1 hb-> n2s[0], then n1 hb-> n2s[:]
+            if verify_pair_proper_synchronization(n1, n2s[0], vio):
                 debug_str += f", n1 -> n2s[{rank}][0]"
                 continue
 
-            # check if the last node of n2s[rank] happens-beofre n1
-            # if n2s[rank][-1] hb->hb, then n2s[rank][:] hb-> n1
-            if verify_pair_proper_synchronization(n2s[rank][-1], n1, vio):
+            # check if the last node of n2s happens-beofre n1
+            # if n2s[-1] hb->hb, then n2s[:] hb-> n1
+            if verify_pair_proper_synchronization(n2s[-1], n1, vio):
                 debug_str += f", n2s[{rank}][-1] -> n1"
                 continue
 
-            # check if n1 happens-before the last node of n2s[rank]
-            # if not, then n1 is certainly not ->hb any nodes of n2s[rank]
-            # similarly, if n2s[rank][0] does not happen-before n1, then
-            # non of n2s[rank] will happen-before n1.
-            if (not verify_pair_proper_synchronization(n1, n2s[rank][-1], vio)) \
-                and (not verify_pair_proper_synchronization(n2s[rank][0], n1, vio)):
-                total_violations += len(n2s[rank])
-                for n2 in n2s[rank]:
-                    if args.show_summary:
+            # check if n1 happens-before the last node of n2s
+            # if not, then n1 is certainly not ->hb any nodes of n2s
+            # similarly, if n2s[0] does not happen-before n1, then
+            # non of n2s will happen-before n1.
+            if (not verify_pair_proper_synchronization(n1, n2s[-1], vio)) \
+                and (not verify_pair_proper_synchronization(n2s[0], n1, vio)):
+                total_violations += len(n2s)
+                for n2 in n2s:
+                    if vio.show_summary:
                         get_violation_info([n1, n2], vio, summary, False)
                     #print(f"{vio.semantics} violation: {n1} {n2}")
                 continue
 
-            # now we are here, its very likely that n1 is not
-            # properly-synchornized with any node of n2s[rank],
-            # but we still need to go through evey pair to make sure.
-            # TODO we could do the previous three checks recursively.
-            for n2 in n2s[rank]:
-                this_pair_ok = (verify_pair_proper_synchronization(n1, n2, vio) or \
-                                verify_pair_proper_synchronization(n2, n1, vio))
-                if not this_pair_ok:
-                    if args.show_summary:
-                        get_violation_info([n1, n2], vio, summary, this_pair_ok)
-                    total_violations += 1
-                    #print(f"{vio.semantics} violation: {n1} {n2}")
+            # now we are here, n1 may be properly-synchornized with
+            # some nodes of n2s. As the order is monotone along n2s
+            # (see verify_pair_happens_before), we use binary search
+            # to find the first n2 that n1 happens-before (first_after),
+            # and the first n2 that does not happen-before n1 (first_not_before).
+            # Only the n2s in between can be violations, except the
+            # ones protected by locks.
+            first_after = bisect_first(lambda i: verify_pair_happens_before(n1, n2s[i], vio), 1, len(n2s))
+            first_not_before = bisect_first(lambda i: not verify_pair_happens_before(n2s[i], n1, vio), 0, len(n2s)-1)
+            for n2 in n2s[first_not_before:first_after]:
+                if vio.near_lock[n2.id]:
+                    continue
+                if vio.show_summary:
+                    get_violation_info([n1, n2], vio, summary, False)
+                total_violations += 1
+                #print(f"{vio.semantics} violation: {n1} {n2}")
 
         t2 = time.time()
         #print(debug_str+", time: %.3f" %(t2-t1))
 
-    if vio.show_summary:
-        print_summary(summary)
-    print("Total semantic violations: %d" %total_violations)
-    print("Total conflict pairs: %d" %total_conflicts)
+    return total_violations, total_conflicts, summary
+
+
+"""
+Same as verify_conflict_groups() but with vio.jobs processes.
+
+The conflict groups are split into consecutive shards (see
+ConflictGroups.split()) that are verified by a pool of forked
+processes. The workers inherit vio, i.e., the graph, the clocks
+and the anchor tables, from the parent process, so nothing but
+the shard number is sent to them. The results (and the printed
+details) of all shards are merged in file order, so the output
+is the same as with a single process.
+"""
+parallel_state = None   # (vio, shards) inherited by the workers
+
+def verify_conflict_groups_parallel(conflict_groups, vio:VerifyIO):
+    global parallel_state
+
+    # a few shards per process to balance the load
+    shards = conflict_groups.split(vio.jobs * 4)
+    if len(shards) <= 1:
+        return verify_conflict_groups(conflict_groups, vio)
+
+    parallel_state = (vio, shards)
+    # do not let the workers inherit buffered output
+    sys.stdout.flush()
+    with multiprocessing.get_context("fork").Pool(min(vio.jobs, len(shards))) as pool:
+        results = pool.map(verify_shard, range(len(shards)), chunksize=1)
+    parallel_state = None
+
+    total_violations, total_conflicts = 0, 0
+    summary = new_summary() if vio.show_summary else None
+    for violations, conflicts, shard_summary, output in results:
+        sys.stdout.write(output)
+        total_violations += violations
+        total_conflicts += conflicts
+        if summary is not None:
+            merge_summary(summary, shard_summary)
+    return total_violations, total_conflicts, summary
+
+
+# Worker of verify_conflict_groups_parallel()
+def verify_shard(i):
+    vio, shards = parallel_state
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        result = verify_conflict_groups(shards[i], vio)
+    return result + (output.getvalue(),)
+
+
+# Return the first i in [lo, hi) for which pred(i) is True,
+# or hi if there is none. pred must be monotone, i.e., False
+# for all i before the returned one and True after.
+def bisect_first(pred, lo, hi):
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if pred(mid):
+            hi = mid
+        else:
+            lo = mid + 1
+    return lo
 
 
 # A helper function to map the mpi edges to a 3D data structure 
@@ -240,6 +494,37 @@ def map_edges(mpi_edges, reader):
     return edges
 
 
+"""
+Index of the mapped mpi edges (see map_edges) for algorithm 4.
+
+For every pair of ranks (rank, peer_rank), the sorted seq_ids of the
+MPI calls of rank whose edge involves peer_rank, and the seq_ids of
+the matching calls of peer_rank.
+"""
+class MPIEdgeIndex:
+    def __init__(self, mapped_mpi_edges):
+        pairs = {}
+        for rank, rank_edges in enumerate(mapped_mpi_edges):
+            for seq_id, calls in rank_edges.items():
+                for t in calls:
+                    if t: pairs.setdefault((rank, t.rank), []).append((seq_id, t.seq_id))
+
+        self.seq_ids, self.partner_seq_ids = {}, {}
+        for key, seq_id_pairs in pairs.items():
+            seq_id_pairs = np.array(sorted(seq_id_pairs), dtype=np.int64)
+            self.seq_ids[key] = seq_id_pairs[:, 0]
+            self.partner_seq_ids[key] = seq_id_pairs[:, 1]
+
+    # seq_id of the peer_rank call of the first MPI edge
+    # of rank after seq_id that involves peer_rank, -1 if none
+    def next_partner(self, rank, seq_id, peer_rank):
+        seq_ids = self.seq_ids.get((rank, peer_rank))
+        if seq_ids is None:
+            return -1
+        i = np.searchsorted(seq_ids, seq_id, side='right')
+        return int(self.partner_seq_ids[(rank, peer_rank)][i]) if i < len(seq_ids) else -1
+
+
 def get_shortest_path(G:VerifyIOGraph, src:VerifyIONode, dst:VerifyIONode):
     path = G.shortest_path(src, dst)
     path_str = ""
@@ -251,14 +536,34 @@ def get_shortest_path(G:VerifyIOGraph, src:VerifyIONode, dst:VerifyIONode):
     return path_str
 
 
-def print_summary(summary):
+# c_ranks_cnt: (c1 rank, c2 rank) -> count, only pairs of ranks
+# that have violations are stored
+def new_summary():
+    return {
+        'c_ranks_cnt': {},
+        'c_files_cnt': {},
+        'c_functions_cnt': {}
+    }
+
+
+# Add the counts of summary other to summary
+def merge_summary(summary, other):
+    for key in ['c_ranks_cnt', 'c_files_cnt', 'c_functions_cnt']:
+        for name, count in other[key].items():
+            summary[key][name] = summary[key].get(name, 0) + count
+
+
+def print_summary(summary, nprocs):
     print("=" * 80)
     print("Details".center(80))
     print("=" * 80)
 
     print(f"{'Rank':<10} {'Conflicts':<20}")
     print("-" * 30)
-    for index, value in enumerate([sum(values) for values in zip(*summary['c_ranks_cnt'])]):
+    rank_cnt = [0] * nprocs
+    for (_, rank), count in summary['c_ranks_cnt'].items():
+        rank_cnt[rank] += count
+    for index, value in enumerate(rank_cnt):
         print(f"{index:<10} {value:<20}")
     print()
 
@@ -277,30 +582,32 @@ def print_summary(summary):
 
 def get_violation_info(nodes: list, vio, summary, this_pair_ok):
     
+    # Call chains are returned as a list of seq ids,
+    # from the innermost call to the outermost call.
     def get_call_full_chain(node, reader):
         call_chain = []
+        call_depths = reader.call_depths[node.rank]
         seq_id = node.seq_id
-        while reader.records[node.rank][seq_id].call_depth > 0:
-            call_chain.append(reader.records[node.rank][seq_id])
+        while call_depths[seq_id] > 0:
+            call_chain.append(seq_id)
             seq_id -= 1
-        call_chain.append(reader.records[node.rank][seq_id])
+        call_chain.append(seq_id)
         return call_chain
 
     def get_call_partial_chain(node, reader):
         call_chain = []
+        call_depths = reader.call_depths[node.rank]
         seq_id = node.seq_id
         added_depths = set()
         
-        while reader.records[node.rank][seq_id].call_depth > 0:
-            current_record = reader.records[node.rank][seq_id]
-            if current_record.call_depth not in added_depths:
-                call_chain.append(current_record)
-                added_depths.add(current_record.call_depth)
+        while call_depths[seq_id] > 0:
+            if call_depths[seq_id] not in added_depths:
+                call_chain.append(seq_id)
+                added_depths.add(call_depths[seq_id])
             seq_id -= 1
         
-        root_record = reader.records[node.rank][seq_id]
-        if root_record.call_depth not in added_depths:
-            call_chain.append(root_record)
+        if call_depths[seq_id] not in added_depths:
+            call_chain.append(seq_id)
         
         return call_chain
 
@@ -314,96 +621,163 @@ def get_violation_info(nodes: list, vio, summary, this_pair_ok):
         func_name = reader.funcs[func_id]
         summary['c_functions_cnt'][func_name] = summary['c_functions_cnt'].get(func_name, 0) + 1
 
-    def build_call_chain_str(call_chain, reader):
-        return "-->".join(reader.funcs[cc.func_id] for cc in call_chain)
+    def build_call_chain_str(rank, call_chain, reader):
+        return "-->".join(reader.funcs[reader.func_ids[rank][seq_id]] for seq_id in call_chain)
 
     left_call_chain = get_call_chain(nodes[0], vio.reader, vio.show_call_chain)
     right_call_chain = get_call_chain(nodes[1], vio.reader, vio.show_call_chain)
     file = vio.reader.records[nodes[0].rank][nodes[0].seq_id].args[0].decode('utf-8')
     if len(left_call_chain) > 0 and len(right_call_chain) > 0:
-        summary['c_ranks_cnt'][nodes[0].rank][nodes[1].rank] += 1
+        ranks = (nodes[0].rank, nodes[1].rank)
+        summary['c_ranks_cnt'][ranks] = summary['c_ranks_cnt'].get(ranks, 0) + 1
         if file not in summary['c_files_cnt']:
             summary['c_files_cnt'][file] = 0
         summary['c_files_cnt'][file] += 1
-        update_function_count(left_call_chain[-1].func_id, summary, vio.reader)
-        update_function_count(right_call_chain[-1].func_id, summary, vio.reader)
+        update_function_count(vio.reader.func_ids[nodes[0].rank][left_call_chain[-1]], summary, vio.reader)
+        update_function_count(vio.reader.func_ids[nodes[1].rank][right_call_chain[-1]], summary, vio.reader)
         if vio.show_details:
-            r_str = build_call_chain_str(right_call_chain, vio.reader)
-            l_str = build_call_chain_str(reversed(left_call_chain), vio.reader)
+            r_str = build_call_chain_str(nodes[1].rank, right_call_chain, vio.reader)
+            l_str = build_call_chain_str(nodes[0].rank, reversed(left_call_chain), vio.reader)
             print(f"{nodes[0]}: {l_str} <--> {nodes[1]}: {r_str} on file {file}, properly synchronized: {this_pair_ok}")
 
 
 
-def custom_semantic(str=None, n1:VerifyIO =None, n2: VerifyIO = None):
+# Semantics verified by --semantics all
+all_semantics = ["POSIX", "MPI-IO", "Commit", "Session"]
 
-    def get_offset(s):
-        s = s.split(":")[1].split("[")[0]
-        return int(s[1:]) if "+" in s else int(s) if "-" in s else 0
+# Parse --semantics: a single semantics, a comma separated
+# list of semantics, or "all". Return the list of semantics.
+def parse_semantics(s):
+    if s == "all":
+        return list(all_semantics)
+    semantics = []
+    for sem in s.split(","):
+        sem = sem.strip()
+        if sem not in all_semantics + ["Custom"]:
+            raise argparse.ArgumentTypeError(f"invalid semantics: '{sem}' (choose from {', '.join(all_semantics)}, Custom or all)")
+        if sem not in semantics:
+            semantics.append(sem)
+    return semantics
 
-    def get_node(conflict_str, node):
-        offset = get_offset(conflict_str)
-        if offset == 0:
-            return node
 
-        sync_arr = conflict_str.split("[")[1].split("]")[0].split(",")
-        po_node_fn = vio.next_po_node if offset > 0 else vio.prev_po_node
-        return po_node_fn(node, sync_arr if sync_arr else None)
-    
-    c1, c2 = str.split("&")
-    return get_node(c1, n1), get_node(c2, n2)
+"""
+Custom semantics compiled from a --semantic_string, e.g.,
 
-    
+    c1:+1[MPI_File_close, MPI_File_sync] & c2:-1[MPI_File_open, MPI_File_sync]
 
+The two sides give the anchors (v1, v2) of a conflicting pair
+(c1, c2), and c1 is properly synchronized with c2 if v1 hb-> v2:
+    c:+k[funcs]:    the k-th next call of funcs after c
+    c:-k[funcs]:    the k-th previous call of funcs before c
+    c:0:            c itself
+With an empty list of funcs ([] or no list), the immediate
+next/previous node is used.
 
+The string is parsed and checked once. The anchors are then
+resolved with the anchor tables of the NodeTable, the same way
+as for the built-in semantics.
+"""
+class CustomSemantics:
+    side_regex = re.compile(r"\s*(c1|c2)\s*:\s*([+-]?\d+)\s*(?:\[([^\]]*)\])?\s*")
+
+    def __init__(self, semantic_string):
+        self.semantic_string = semantic_string
+        sides = semantic_string.split("&")
+        if len(sides) != 2:
+            raise ValueError(f"expected two sides separated by '&': '{semantic_string}'")
+        # (offset, funcs or None) of c1 and c2
+        self.sides = [self.__parse(side, name) for side, name in zip(sides, ["c1", "c2"])]
+
+    @classmethod
+    def __parse(cls, side, name):
+        m = cls.side_regex.fullmatch(side)
+        if not m or m.group(1) != name:
+            raise ValueError(f"invalid {name} side: '{side.strip()}' (expected {name}:<offset>[func, ...])")
+        funcs = [f.strip() for f in (m.group(3) or "").split(",") if f.strip()]
+        return int(m.group(2)), (funcs if funcs else None)
+
+    def __str__(self):
+        return self.semantic_string
+
+    # Anchor ids of nodes (ids) for side (0: c1, 1: c2), -1 for none
+    def anchor_ids(self, ids, side, nodes):
+        offset, funcs = self.sides[side]
+        ids = np.asarray(ids, dtype=np.int64)
+        for _ in range(abs(offset)):
+            valid = ids >= 0
+            safe_ids = np.where(valid, ids, 0)
+            if funcs:
+                step_ids = nodes.anchor_tables(funcs)[0 if offset > 0 else 1][safe_ids]
+            elif offset > 0:
+                step_ids = np.where(safe_ids + 1 < nodes.rank_offsets[nodes.rank[safe_ids] + 1], safe_ids + 1, -1)
+            else:
+                step_ids = np.where(safe_ids > nodes.rank_offsets[nodes.rank[safe_ids]], safe_ids - 1, -1)
+            ids = np.where(valid, step_ids, -1)
+        return ids
+
+
+# Parse --semantic_string into CustomSemantics
+def parse_semantic_string(s):
+    try:
+        return CustomSemantics(s)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("traces_folder")
-    parser.add_argument("--semantics", type=str, choices=["POSIX", "MPI-IO", "Commit", "Session", "Custom"],
-                        default="MPI-IO", help="Verify if I/O operations are properly synchronized under the specific semantics")
-    parser.add_argument("--algorithm", type=int, choices=[1, 2, 3, 4],
-                        default=3, help="1: graph reachibility, 2: transitive closure, 3: vector clock, 4: on-the-fly MPI check")
-    parser.add_argument("--semantic_string", type=str, default="c1:+1[MPI_File_close, MPI_File_sync] & c2:-1[MPI_File_open, MPI_File_sync]")
+    parser.add_argument("--semantics", type=parse_semantics, default="MPI-IO",
+                        help="Verify if I/O operations are properly synchronized under the specific semantics: "
+                             "POSIX, MPI-IO, Commit, Session or Custom. Use a comma separated list or 'all' "
+                             "to verify several semantics in one run")
+    parser.add_argument("--algorithm", type=int, choices=[1, 2, 3, 4, 5],
+                        default=3, help="1: graph reachibility, 2: transitive closure, 3: vector clock, 4: on-the-fly MPI check, 5: tree clock (experimental, usually slower than 3)")
+    parser.add_argument("--semantic_string", type=parse_semantic_string, default="c1:+1[MPI_File_close, MPI_File_sync] & c2:-1[MPI_File_open, MPI_File_sync]",
+                        help="Custom semantics (--semantics Custom): c1:+k[funcs] & c2:-k[funcs]")
     parser.add_argument("--show_details", action="store_true", help="Show details of the conflicts")
     parser.add_argument("--show_summary", action="store_true", help="Show summary of the conflicts")
     parser.add_argument("--show_call_chain", action="store_true", help="Show the call chain of the conflicting operations")
+    parser.add_argument("--graph_backend", type=str, choices=list(graph_backends), default="csr",
+                        help="Happens-before graph implementation, networkx is slower but serves as reference")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="Number of processes used to verify the conflicts (step 5)")
+    parser.add_argument("--cache", action="store_true", help="Cache the decoded trace in the trace folder and reuse it in later runs")
     args = parser.parse_args()
+    if args.algorithm == 5 and args.graph_backend != "csr":
+        parser.error("--algorithm 5 (tree clock) requires --graph_backend csr")
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
 
     vio = VerifyIO(args)
     #import psutil
     #print('1. RAM Used (GB):', psutil.virtual_memory()[3]/1000000000)
 
     t1 = time.time()
-    vio.reader = RecorderReader(args.traces_folder)
+    vio.reader = RecorderReader(args.traces_folder, use_cache=args.cache)
     #print('2. RAM Used (GB):', psutil.virtual_memory()[3]/1000000000)
 
-    vio.all_nodes, conflicts = read_verifyio_nodes_and_conflicts(vio.reader)
+    scan = scan_trace(vio.reader)
+    vio.all_nodes, conflicts = read_verifyio_nodes_and_conflicts(vio.reader, scan)
+    vio.near_lock = build_lock_index(vio.reader, vio.all_nodes)
     t2 = time.time()
     print("Step 1. read trace records and conflicts time: %.3f secs" %(t2-t1))
     #print('3. RAM Used (GB):', psutil.virtual_memory()[3]/1000000000)
 
-    # TODO: do we need to sort here?
-    # the recorder traces should be sorted already
-    # and the conflict operations are also sorted before writing out.
-    #
-    # Set the index of each node with respect to per-rank VerifyIONode list
-    # this index will be used later to accelerate next_po_node/prev_po_node
-    for rank in range(vio.reader.nprocs):
-        vio.all_nodes[rank] = sorted(vio.all_nodes[rank], key=lambda x: x.seq_id)
-        for i, n in enumerate(vio.all_nodes[rank]): n.index = i
-    #print('5. RAM Used (GB):', psutil.virtual_memory()[3]/1000000000)
+    # Nodes in the NodeTable are sorted by seq_id per rank
+    # and have their index with respect to the per-rank node list,
+    # which is used later to accelerate next_po_node/prev_po_node
 
     # get mpi calls and matched edges
     t1 = time.time()
-    mpi_edges = match_mpi_calls(vio.reader)
+    mpi_edges = match_mpi_calls(vio.reader, vio.all_nodes, scan)
     t2 = time.time()
     #print('6. RAM Used (GB):', psutil.virtual_memory()[3]/1000000000)
     print("Step 2. match mpi calls: %.3f secs, mpi edges: %d" %((t2-t1),len(mpi_edges)))
 
     if vio.algorithm !=4:
         t1 = time.time()
-        vio.G = VerifyIOGraph(vio.all_nodes, mpi_edges, include_vc=True)
+        vio.G = graph_backends[vio.graph_backend](vio.all_nodes, mpi_edges, include_vc=True)
         t2 = time.time()
         print("Step 3. build happens-before graph: %.3f secs, nodes: %d" %((t2-t1), vio.G.num_nodes()))
         #print('7. RAM Used (GB):', psutil.virtual_memory()[3]/1000000000)
@@ -411,19 +785,32 @@ if __name__ == "__main__":
         # Correct code (traces) should generate a DAG without any cycles
         if vio.G.check_cycles(): quit()
 
-        if vio.algorithm == 2 or vio.algorithm == 3:
+        if vio.algorithm == 2:
+            t1 = time.time()
+            vio.G.run_transitive_closure()
+            t2 = time.time()
+            print("Step 4. run transitive closure algorithm: %.3f secs" %(t2-t1))
+        elif vio.algorithm == 3:
             t1 = time.time()
             vio.G.run_vector_clock()
-            #vio.G.run_transitive_closure()
             t2 = time.time()
             print("Step 4. run vector clock algorithm: %.3f secs" %(t2-t1))
             #print('8. RAM Used (GB):', psutil.virtual_memory()[3]/1000000000)
             # vio.G.plot_graph("vgraph.jpg")
+        elif vio.algorithm == 5:
+            t1 = time.time()
+            vio.G.run_tree_clock()
+            t2 = time.time()
+            print("Step 4. run tree clock algorithm: %.3f secs" %(t2-t1))
     else:
-        mapped_mpi_edges = map_edges(mpi_edges, vio.reader)
+        vio.mpi_edge_index = MPIEdgeIndex(map_edges(mpi_edges, vio.reader))
 
-    t1 = time.time()
-    verify_execution_proper_synchronization(conflicts, vio)
-    t2 = time.time()
-    print("Step 5. %s semantics verification time: %.3f secs" %(vio.semantics, t2-t1))
+    # Steps 1-4 do not depend on the semantics, so for multiple
+    # semantics only the verification step is repeated
+    for semantics in args.semantics:
+        vio.semantics = semantics
+        t1 = time.time()
+        verify_execution_proper_synchronization(conflicts, vio)
+        t2 = time.time()
+        print("Step 5. %s semantics verification time: %.3f secs" %(vio.semantics, t2-t1))
     #print('9. RAM Used (GB):', psutil.virtual_memory()[3]/1000000000)
@@ -1,26 +1,46 @@
 #!/usr/bin/env python
 # encoding: utf-8
 import networkx as nx
+import numpy as np
 
+'''
+A lightweight view of a node stored in a NodeTable.
+All attributes are read from the table on access.
+'''
 class VerifyIONode:
-    def __init__(self, rank, seq_id, func, fd = -1, mpifh = None):
-        self.rank = rank
-        # This is the index with respect to all
-        # Recorder trace records
-        self.seq_id = seq_id
-        # This is the index with respect to all
-        # VerifyIONode we read
-        self.index  = -1
-        self.func = func
-        # An integer maps to the filename
-        self.fd = fd
-        # Store the MPI-IO file handle so we can match
-        # I/O calls with sync/commit calls during
-        # the verification.
-        self.mpifh = mpifh
-
-    def graph_key(self):
-        return str(self.rank) + "-" + str(self.seq_id) + "-" + str(self.func)
+    __slots__ = ('table', 'id')
+
+    def __init__(self, table, nid):
+        self.table = table
+        self.id = nid       # dense node id in the table
+
+    @property
+    def rank(self):
+        return int(self.table.rank[self.id])
+
+    # This is the index with respect to all
+    # Recorder trace records
+    @property
+    def seq_id(self):
+        return int(self.table.seq_id[self.id])
+
+    # This is the index with respect to all
+    # VerifyIONode of the same rank
+    @property
+    def index(self):
+        return int(self.table.index[self.id])
+
+    @property
+    def func(self):
+        return self.table.funcs[self.table.func_id[self.id]]
+
+    # The MPI-IO file handle (MPI_File_* calls) or the file
+    # name (metadata calls), so we can match I/O calls with
+    # sync/commit calls during the verification.
+    @property
+    def mpifh(self):
+        fh_id = self.table.fh_id[self.id]
+        return self.table.fh_strings[fh_id] if fh_id >= 0 else None
 
     def __str__(self):
         #if "write" in self.func or "read" in self.func or \
@@ -31,14 +51,200 @@ class VerifyIONode:
         return "<Rank %d: %dth %s>" %(self.rank, self.seq_id, self.func)
 
 
+'''
+Struct-of-arrays storage of all VerifyIONodes (MPI calls,
+metadata calls and conflicting I/O operations).
+
+Nodes are addressed by a dense integer id. Nodes of a rank
+have consecutive ids and are sorted by seq_id, i.e.,
+    id = rank_offsets[rank] + index
+
+rank[id], seq_id[id], index[id], func_id[id]: typed per-node arrays
+fh_id[id]: id of the interned file handle in fh_strings, -1 if none
+'''
+class NodeTable:
+    UNRESOLVED = -2     # see anchor_memo()
+
+    # funcs: function names of the trace (reader.funcs)
+    # func_ids[rank]: func id of every record of the rank (reader.func_ids)
+    # rank_seq_ids[rank]: seq ids of the nodes of the rank
+    # rank_fhs[rank]: file handle (str or None) of each node in rank_seq_ids
+    # If a seq id is given more than once, the first one is kept.
+    def __init__(self, funcs, func_ids, rank_seq_ids, rank_fhs):
+        self.nprocs = len(rank_seq_ids)
+        self.funcs = funcs
+        self.func_id_map = {func: i for i, func in enumerate(funcs)}
+
+        fh_table = {}
+        sorted_seq_ids, sorted_fh_ids = [], []
+        for rank in range(self.nprocs):
+            seq_ids = np.asarray(rank_seq_ids[rank], dtype=np.int32)
+            fh_ids = np.array([-1 if fh is None else fh_table.setdefault(fh, len(fh_table))
+                               for fh in rank_fhs[rank]], dtype=np.int32)
+            order = np.argsort(seq_ids, kind='stable')
+            seq_ids, fh_ids = seq_ids[order], fh_ids[order]
+            keep = np.ones(len(seq_ids), dtype=bool)
+            keep[1:] = seq_ids[1:] != seq_ids[:-1]
+            sorted_seq_ids.append(seq_ids[keep])
+            sorted_fh_ids.append(fh_ids[keep])
+        self.fh_strings = list(fh_table)
+
+        counts = [len(seq_ids) for seq_ids in sorted_seq_ids]
+        self.rank_offsets = np.zeros(self.nprocs+1, dtype=np.int64)
+        self.rank_offsets[1:] = np.cumsum(counts)
+
+        concat = lambda arrays: np.concatenate(arrays).astype(np.int32) if arrays else np.empty(0, dtype=np.int32)
+        self.rank    = np.repeat(np.arange(self.nprocs, dtype=np.int32), counts)
+        self.seq_id  = concat(sorted_seq_ids)
+        self.index   = concat([np.arange(n, dtype=np.int32) for n in counts])
+        self.func_id = concat([func_ids[rank][sorted_seq_ids[rank]] for rank in range(self.nprocs)])
+        self.fh_id   = concat(sorted_fh_ids)
+
+        self.anchors = {}           # cache of anchor_tables()
+        self.anchor_memos = {}      # cache of anchor_memo()
+
+    def __len__(self):
+        return len(self.seq_id)
+
+    def num_rank_nodes(self, rank):
+        return int(self.rank_offsets[rank+1] - self.rank_offsets[rank])
+
+    def node(self, nid):
+        return VerifyIONode(self, nid)
+
+    # Iterate over all nodes of a rank (in program order)
+    def rank_nodes(self, rank):
+        for nid in range(self.rank_offsets[rank], self.rank_offsets[rank+1]):
+            yield VerifyIONode(self, nid)
+
+    # Node ids of the given seq ids of a rank, -1 if not a node.
+    def ids_of(self, rank, seq_ids):
+        start, end = self.rank_offsets[rank], self.rank_offsets[rank+1]
+        rank_seq_ids = self.seq_id[start:end]
+        pos = np.searchsorted(rank_seq_ids, seq_ids)
+        found = pos < len(rank_seq_ids)
+        found[found] = rank_seq_ids[pos[found]] == np.asarray(seq_ids)[found]
+        return np.where(found, start + pos, -1)
+
+    def id_of(self, rank, seq_id):
+        return int(self.ids_of(rank, np.array([seq_id]))[0])
+
+    # The VerifyIONode of (rank, seq_id), None if not a node.
+    def find(self, rank, seq_id):
+        nid = self.id_of(rank, seq_id)
+        return VerifyIONode(self, nid) if nid >= 0 else None
+
+    def func_ids_of(self, funcs):
+        return np.array([self.func_id_map[f] for f in funcs if f in self.func_id_map], dtype=np.int32)
+
+    # Anchor tables of a set of funcs, computed once for each set:
+    # next_ids[id] / prev_ids[id] is the id of the next / previous
+    # node of the same rank that called one of funcs, -1 if none.
+    def anchor_tables(self, funcs):
+        key = frozenset(funcs)
+        if key not in self.anchors:
+            anchor_ids = np.flatnonzero(np.isin(self.func_id, self.func_ids_of(funcs)))
+            all_ids = np.arange(len(self), dtype=np.int64)
+            padded = np.append(anchor_ids, -1)
+
+            # first anchor after each node, last anchor before each node
+            next_ids = padded[np.searchsorted(anchor_ids, all_ids, side='right')]
+            next_ids[next_ids >= self.rank_offsets[self.rank+1]] = -1
+            prev_ids = padded[np.searchsorted(anchor_ids, all_ids, side='left') - 1]
+            prev_ids[prev_ids < self.rank_offsets[self.rank]] = -1
+            self.anchors[key] = (next_ids, prev_ids)
+        return self.anchors[key]
+
+    # Memo of resolved anchors for a key (e.g., a semantics), filled
+    # lazily by the caller: a (2, len) array of the anchor ids of each
+    # node as the first and as the second operation of a pair, -1 for
+    # no anchor and UNRESOLVED for nodes not resolved yet.
+    def anchor_memo(self, key):
+        memo = self.anchor_memos.get(key)
+        if memo is None:
+            memo = self.anchor_memos[key] = np.full((2, len(self)), self.UNRESOLVED, dtype=np.int64)
+        return memo
+
+    # next (program-order) node of funcs in the same rank
+    # if funcs is None, return the immediate next node
+    def next_po_node(self, current, funcs):
+        if funcs:
+            nid = self.anchor_tables(funcs)[0][current.id]
+        else:
+            nid = current.id + 1 if current.id + 1 < self.rank_offsets[current.rank+1] else -1
+        return VerifyIONode(self, int(nid)) if nid >= 0 else None
+
+    # previous (program-order) node of funcs in the same rank
+    # if funcs is None, return the immediate previous node
+    def prev_po_node(self, current, funcs):
+        if funcs:
+            nid = self.anchor_tables(funcs)[1][current.id]
+        else:
+            nid = current.id - 1 if current.id > self.rank_offsets[current.rank] else -1
+        return VerifyIONode(self, int(nid)) if nid >= 0 else None
+
+
+'''
+Synchronization edges of the happens-before graph, i.e., all
+edges except the program-order edges between neighbouring nodes
+of the same rank. Shared by VerifyIOGraph and CSRGraph.
+
+Point-to-point calls give an edge from the send to the receive.
+All collective calls are handled in the same way, we just use them
+as a fence to establish order between I/O calls: each matched
+collective gets one ghost node g, with an edge h -> g from every
+involved call h and an edge from g to the program-order successor
+of every h. Ghost node k has id len(all_nodes) + k. The
+program-order edges of h are kept, they are implied by the fence.
+One ghost node per collective keeps this linear in the number
+of involved calls.
+
+Return (heads, tails, number of ghost nodes), where heads and
+tails are int64 arrays of node ids.
+'''
+def build_sync_edges(all_nodes, mpi_edges):
+    from match_mpi import MPICallType
+
+    N = len(all_nodes)
+    rank_ends = all_nodes.rank_offsets[1:].tolist()
+    heads, tails = [], []
+    ghost_node_count = 0
+    for edge in mpi_edges:
+
+        # case i: point to point calls
+        if edge.call_type == MPICallType.POINT_TO_POINT:
+            heads.append(edge.head.id)
+            tails.append(edge.tail.id)
+            continue
+
+        # case ii: collective calls
+        mpi_calls = edge.get_all_involved_calls()
+        if len(mpi_calls) <= 1: continue
+        ghost_id = N + ghost_node_count
+        for h in mpi_calls:
+            heads.append(h.id)
+            tails.append(ghost_id)
+            if h.id + 1 < rank_ends[h.rank]:
+                heads.append(ghost_id)
+                tails.append(h.id + 1)
+        ghost_node_count += 1
+
+    return np.array(heads, dtype=np.int64), np.array(tails, dtype=np.int64), ghost_node_count
+
+
 '''
 Essentially a wrapper for networkx DiGraph
+
+Graph nodes are the dense integer ids of the NodeTable. Ghost
+nodes (see __build_graph) are numbered after all table nodes,
+i.e., ghost node k has id len(nodes) + k and rank nprocs.
 '''
 class VerifyIOGraph:
     def __init__(self, nodes, edges, include_vc=False):
         self.G = nx.DiGraph()
-        self.nodes = nodes      # A list of VerifyIONode sorted by seq_id
+        self.nodes = nodes      # NodeTable of all VerifyIONodes
         self.include_vc = include_vc
+        self.num_ghost_nodes = 0
         self.__build_graph(nodes, edges, include_vc)
 
     def num_nodes(self):
@@ -46,32 +252,16 @@ class VerifyIOGraph:
 
     # next (program-order) node of funcs in the sam rank
     def next_po_node(self, current, funcs):
-        nodes = self.nodes[current.rank]
-        if not funcs:
-            return nodes[current.index+1]
-        target = None
-        for i in range(current.index+1, len(nodes)):
-            if nodes[i].func in funcs:
-                target = nodes[i]
-                break
-        return target
+        return self.nodes.next_po_node(current, funcs)
 
     # previous (program-order) node of funcs in the same rank
     def prev_po_node(self, current, funcs):
-        nodes = self.nodes[current.rank]
-        if not funcs:
-            return nodes[current.index-1]
-        target = None
-        for i in range(current.index-1, 0, -1):
-            if nodes[i].func in funcs:
-                target = nodes[i]
-                break
-        return target
+        return self.nodes.prev_po_node(current, funcs)
 
     # next (happens-beofre) node of funcs in the target rank
     def next_hb_node(self, current, funcs, target_rank):
         target = None
-        nodes = self.nodes[target_rank]
+        nodes = self.nodes.rank_nodes(target_rank)
         for target in nodes:
             if (target.func in funcs) and (self.has_path(current, target)):
                 target.append(target)
@@ -79,13 +269,13 @@ class VerifyIOGraph:
         return target
 
     def add_edge(self, h, t):
-        self.G.add_edge(h.graph_key(), t.graph_key())
+        self.G.add_edge(h.id, t.id)
 
     def remove_edge(self, h, t):
-        self.G.remove_edge(h.graph_key(), t.graph_key())
+        self.G.remove_edge(h.id, t.id)
 
     def has_path(self, src, dst):
-        return nx.has_path(self.G, src.graph_key(), dst.graph_key())
+        return nx.has_path(self.G, src.id, dst.id)
 
     def plot_graph(self, fname):
         import matplotlib.pyplot as plt
@@ -94,27 +284,39 @@ class VerifyIOGraph:
         plt.show()
 
     def get_vector_clock(self, n):
-        return self.G.nodes[n.graph_key()]['vc']
+        return self.G.nodes[n.id]['vc']
 
     # caller need to assume there is no cycle
     # in the DAG.
     def run_vector_clock(self):
-        for node_key in nx.topological_sort(self.G):
-            vc = self.G.nodes[node_key]['vc']
-            for eachpred in self.G.predecessors(node_key):
+        ranks = self.ranks.tolist()
+        for nid in nx.topological_sort(self.G):
+            vc = self.G.nodes[nid]['vc']
+            for eachpred in self.G.predecessors(nid):
                 pred_vc = self.G.nodes[eachpred]['vc'].copy()
-                pred_vc[self.key2rank(eachpred)] += 1
+                pred_vc[ranks[eachpred]] += 1
                 vc = list(map(max, zip(vc, pred_vc)))
 
-            self.G.nodes[node_key]['vc'] = vc
-            #print(node_key, vc)
+            self.G.nodes[nid]['vc'] = vc
+            #print(nid, vc)
 
     def run_transitive_closure(self):
-        tc = nx.transitive_closure(self.G)
+        self.tc = nx.transitive_closure(self.G, reflexive=False)
 
-    # Retrive rank from node key
-    def key2rank(self, key):
-        return (int)(key.split('-')[0])
+    # Check if dst is reachable from src using the transitive
+    # closure, False if src is dst (same as the vector clocks)
+    def closure_has_path(self, src, dst):
+        return self.tc.has_edge(src.id, dst.id)
+
+    # Retrive rank from node id (nprocs for ghost nodes)
+    def id2rank(self, nid):
+        return int(self.ranks[nid])
+
+    # VerifyIONode of a node id, or a string for ghost nodes
+    def id2node(self, nid):
+        if nid < len(self.nodes):
+            return self.nodes.node(nid)
+        return "<Ghost %d>" %(nid - len(self.nodes))
 
     def shortest_path(self, src, dst):
 
@@ -122,96 +324,54 @@ class VerifyIOGraph:
             print("shortest_path Error: must specify src and dst (VerifyIONode)")
             return []
 
-        # nx.shortest_path will return a list of nodes in
-        # keys. we then retrive the real VerifyIONode and return a
+        # nx.shortest_path will return a list of node ids.
+        # we then retrive the real VerifyIONode and return a
         # list of them
-        path_in_keys = nx.shortest_path(self.G, src.graph_key(), dst.graph_key())
+        path_in_ids = nx.shortest_path(self.G, src.id, dst.id)
         path = []
-        for key in path_in_keys:
-            path.append(key)
+        for nid in path_in_ids:
+            path.append(self.id2node(nid))
         return path
 
 
     # private method to build the networkx DiGraph
     # called only by __init__
-    # nodes: per rank of nodes of type VerifyIONode
+    # nodes: NodeTable of all VerifyIONodes
     # Add neighbouring nodes of the same rank
     # This step will add all nodes
     def __build_graph(self, all_nodes, mpi_edges, include_vc):
         # 1. Add program orders
-        nprocs = len(all_nodes)
+        nprocs = all_nodes.nprocs
         for rank in range(nprocs):
-            for i in range(len(all_nodes[rank]) - 1):
-                h = all_nodes[rank][i]
-                t = all_nodes[rank][i+1]
-                self.add_edge(h, t)
-
-                # Include vector clock for each node
-                if not include_vc: continue
-                vc1 = [0] * (nprocs + 1)    # one more for ghost rank
-                vc2 = [0] * (nprocs + 1)    # one more for ghost rank 
-                vc1[rank] = i
-                vc2[rank] = i+1
-                self.G.nodes[h.graph_key()]['vc'] = vc1
-                self.G.nodes[t.graph_key()]['vc'] = vc2
-
-            # corner case: when this rank has only one node
-            # the code will not run into the previous for loop
-            if len(all_nodes[rank]) == 1:
-                n = all_nodes[rank][0]
-                self.G.add_node(n.graph_key(), vc=[0]*(nprocs+1))
+            start, end = int(all_nodes.rank_offsets[rank]), int(all_nodes.rank_offsets[rank+1])
+            self.G.add_nodes_from(range(start, end))
+            self.G.add_edges_from(zip(range(start, end-1), range(start+1, end)))
+
+            # Include vector clock for each node
+            if not include_vc: continue
+            for i, nid in enumerate(range(start, end)):
+                vc = [0] * (nprocs + 1)     # one more for ghost rank
+                vc[rank] = i
+                self.G.nodes[nid]['vc'] = vc
 
         # 2. Add synchornzation orders (using mpi edges)
         # Before calling this function, we should
         # have added all nodes. We use this function
-        # to add edges of matching MPI calls
-        from match_mpi import MPICallType
-        ghost_node_count = 0
-        for edge in mpi_edges:
-
-            # case i: point to point calls
-            if edge.call_type == MPICallType.POINT_TO_POINT:
-                self.add_edge(edge.head, edge.tail)
-                continue
-
-            # case ii: collective calls
-            # We handle all collect calls in a same way
-            # just use them as a fence to establish order
-            # between I/O calls
-            # add a ghost node and connect all predecessors
-            # and successors from all ranks.
-            # This prvents circle
-            mpi_calls = edge.get_all_involved_calls()
-            if len(mpi_calls) <= 1: continue
-            for mpi_call in mpi_calls:
-
-                # Add a ghost node and connect all predecessors
-                # and successors from all ranks. This prvents the circle
-                ghost_node = VerifyIONode(rank=nprocs, seq_id=ghost_node_count, func="ghost")
-                for h in mpi_calls:
-                    # use list() to make a copy to avoid the runtime
-                    # error of "dictionary size changed during iteration"
-                    try:
-                        successors = list(self.G.successors(h.graph_key()))
-                        for successor in successors:
-                            self.G.remove_edge(h.graph_key(), successor)
-                        if len(list(self.G.successors(h.graph_key()))) != 0 :
-                            print("Not possible!")
-                        for successor in successors:
-                            self.G.add_edge(ghost_node.graph_key(), successor)
-                    except nx.exception.NetworkXError:
-                        # when the node has no successors, the G.successors()
-                        # function through an error instead of an empty list
-                        # (e.g., the last node in the graph)
-                        pass
-
-                for h in mpi_calls:
-                    self.add_edge(h, ghost_node)
-
-                vc = [0] * (nprocs + 1)
-                vc[nprocs] = ghost_node_count
-                self.G.nodes[ghost_node.graph_key()]['vc'] = vc
-                ghost_node_count += 1
+        # to add edges of matching MPI calls and
+        # the ghost nodes of collective calls
+        heads, tails, ghost_node_count = build_sync_edges(all_nodes, mpi_edges)
+        for k in range(ghost_node_count):
+            ghost_id = len(all_nodes) + k
+            self.G.add_node(ghost_id)
+            if not include_vc: continue
+            vc = [0] * (nprocs + 1)
+            vc[nprocs] = k
+            self.G.nodes[ghost_id]['vc'] = vc
+        self.G.add_edges_from(zip(heads.tolist(), tails.tolist()))
+
+        # rank of every node id, ghost nodes have rank nprocs
+        self.num_ghost_nodes = ghost_node_count
+        self.ranks = np.append(all_nodes.rank, np.full(ghost_node_count, nprocs, dtype=np.int32))
 
     # Detect cycles of the graph
     # correct code should contain no cycles.
@@ -233,10 +393,10 @@ class VerifyIOGraph:
             simplified_cycle = []
             for edge in cycle:
                 c1, c2 = edge[0], edge[1]
-                rank1 = self.key2rank(c1)
-                rank2 = self.key2rank(c2)
+                rank1 = self.id2rank(c1)
+                rank2 = self.id2rank(c2)
                 if (rank1 != rank2):
-                    simplified_cycle.append(edge)
+                    simplified_cycle.append((str(self.id2node(c1)), str(self.id2node(c2))))
             print(simplified_cycle)
             has_cycles = True
         except nx.exception.NetworkXNoCycle: